@@ -0,0 +1,45 @@
+# Fixtures of the benchmark suite (pytest-benchmark).
+#
+# common.py computes its paths (APPS_DIR, ICE_DIR...) from $HOME when it's
+# imported, so the whole suite runs in a temporary home directory.
+#
+# Usage: make benchmark-baseline (once), then make benchmark
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HOME_DIR = tempfile.mkdtemp(prefix="webapp-manager-bench-")
+os.environ["HOME"] = HOME_DIR
+sys.path.insert(0, os.path.join(ROOT_DIR, "usr", "lib", "webapp-manager"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+FIREFOX_PROFILE_TEMPLATE = os.path.join(ROOT_DIR, "usr", "share", "webapp-manager", "firefox", "profile")
+FIREFOX_NAVBAR_CSS = os.path.join(ROOT_DIR, "usr", "share", "webapp-manager", "firefox", "userChrome-with-navbar.css")
+
+from launchers import create_launchers
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(HOME_DIR, ignore_errors=True)
+
+# Synthetic app directories, created once per size
+@pytest.fixture(scope="session")
+def apps_dirs():
+    dirs = {}
+    def get_apps_dir(num_launchers):
+        if num_launchers not in dirs:
+            dirs[num_launchers] = create_launchers(os.path.join(HOME_DIR, "apps-%d" % num_launchers), num_launchers)
+        return dirs[num_launchers]
+    return get_apps_dir
+
+@pytest.fixture
+def manager(monkeypatch):
+    common = pytest.importorskip("common")
+    monkeypatch.setattr(common, "FIREFOX_PROFILE_TEMPLATE", FIREFOX_PROFILE_TEMPLATE)
+    monkeypatch.setattr(common, "FIREFOX_NAVBAR_CSS", FIREFOX_NAVBAR_CSS)
+    # Don't measure (or depend on) the desktop database of the system
+    monkeypatch.setattr(common, "update_desktop_database", lambda: None)
+    return common.WebAppManager()
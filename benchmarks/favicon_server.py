@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# Local stand-in for websites, used by the favicon benchmarks.
+#
+# Each site is a path prefix (/<site>/), which serves a page and its icons:
+#  - /fast/: a page with an ICO (several sizes), an apple-touch-icon and an og:image
+#  - /large/: same as fast, but the og:image is a large photo-like PNG
+#  - /slow/: the page and the icons take SLOW_DELAY seconds to respond
+#  - /huge/: the og:image is bigger than IMAGE_MAX_SIZE (it's ignored)
+#
+# It can also be run on its own, to try the favicon search of the application:
+# Usage: benchmarks/favicon_server.py [port]
+import http.server
+import os
+import sys
+import threading
+import time
+from io import BytesIO
+
+SLOW_DELAY = 2 # seconds
+PAGE_PADDING = 64 * 1024 # body content, after the <head>
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(site)s</title>
+<link rel="icon" href="favicon.ico">
+<link rel="apple-touch-icon" href="touch.png">
+<meta property="og:image" content="og.png">
+</head>
+<body>
+%(padding)s
+</body>
+</html>
+"""
+
+def get_image_data(size, format, sizes=None, noise=False):
+    from PIL import Image
+    if noise:
+        # Doesn't compress, like a photo
+        image = Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3))
+    else:
+        image = Image.new("RGBA", size, (40, 120, 200, 255))
+    data = BytesIO()
+    if sizes != None:
+        image.save(data, format, sizes=sizes)
+    else:
+        image.save(data, format)
+    return data.getvalue()
+
+class FaviconServer():
+
+    def __init__(self, port=0):
+        favicon = get_image_data((64, 64), "ICO", sizes=[(16, 16), (32, 32), (64, 64)])
+        touch = get_image_data((180, 180), "PNG")
+        og = get_image_data((1200, 630), "PNG")
+        large = get_image_data((1000, 1000), "PNG", noise=True)
+        huge = get_image_data((1400, 1400), "PNG", noise=True)
+        self.sites = {"fast": {"favicon.ico": favicon, "touch.png": touch, "og.png": og},
+                      "large": {"favicon.ico": favicon, "touch.png": touch, "og.png": large},
+                      "slow": {"favicon.ico": favicon, "touch.png": touch, "og.png": og},
+                      "huge": {"favicon.ico": favicon, "touch.png": touch, "og.png": huge}}
+        for site, files in self.sites.items():
+            files[""] = (PAGE % {"site": site, "padding": "<p>Lorem ipsum</p>\n" * (PAGE_PADDING // 19)}).encode("UTF-8")
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), self.get_handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def get_handler_class(self):
+        sites = self.sites
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                parts = self.path.split("?")[0].strip("/").split("/", 1)
+                site = parts[0]
+                filename = parts[1] if len(parts) > 1 else ""
+                if site not in sites or filename not in sites[site]:
+                    self.send_error(404)
+                    return
+                if site == "slow":
+                    time.sleep(SLOW_DELAY)
+                data = sites[site][filename]
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8" if filename == "" else "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except ConnectionError:
+                    # The client stopped reading (the page head was found or the image is too big)
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def get_url(self, site):
+        return "http://127.0.0.1:%d/%s/" % (self.server.server_address[1], site)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    server = FaviconServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
+    for site in sorted(server.sites):
+        print(server.get_url(site))
+    server.server.serve_forever()
@@ -0,0 +1,58 @@
+# Synthetic launchers, shared by the benchmarks.
+#
+# One launcher in webapp_ratio is a webapp (Firefox, Chromium and Epiphany in turn),
+# the other ones are regular applications which the launcher scan has to skip.
+import os
+
+WEBAPP_RATIO = 4
+WEBAPP_LAUNCHER = """[Desktop Entry]
+Version=1.0
+Name=Bench %(i)d
+Comment=Bench %(i)d (Web App)
+Exec=%(exec)s
+%(profile_key)s=Bench%(i)d
+Terminal=false
+X-MultipleArgs=false
+Type=Application
+Icon=webapp-manager
+Categories=GTK;WebApps;
+MimeType=text/html;text/xml;application/xhtml_xml;
+StartupWMClass=ICE-SSB-Bench%(i)d
+StartupNotify=true
+"""
+WEBAPP_EXECS = [("IceFirefox", "firefox --class ICE-SSB-Bench%(i)d --profile /tmp/Bench%(i)d --no-remote https://bench%(i)d.example.com"),
+                ("X-ICE-SSB-Profile", "chromium --app=https://bench%(i)d.example.com --class=ICE-SSB-Bench%(i)d --user-data-dir=/tmp/Bench%(i)d"),
+                ("IceEpiphany", "epiphany --application-mode --profile=\"/tmp/epiphany-Bench%(i)d\" https://bench%(i)d.example.com")]
+APPLICATION_LAUNCHER = """[Desktop Entry]
+Name=Application %(i)d
+Name[fr]=Application %(i)d
+GenericName=Text Editor
+Comment=Edit text files
+Exec=application-%(i)d %%U
+Icon=accessories-text-editor
+Terminal=false
+Type=Application
+Categories=GTK;Utility;TextEditor;
+MimeType=text/plain;
+StartupNotify=true
+Actions=new-window;
+
+[Desktop Action new-window]
+Name=New Window
+Exec=application-%(i)d --new-window
+"""
+
+# Creates a directory with num_launchers launchers, returns its path
+def create_launchers(directory, num_launchers, webapp_ratio=WEBAPP_RATIO):
+    os.makedirs(directory)
+    for i in range(num_launchers):
+        if i % webapp_ratio == 0:
+            profile_key, exec_line = WEBAPP_EXECS[(i // webapp_ratio) % len(WEBAPP_EXECS)]
+            content = WEBAPP_LAUNCHER % {"i": i, "exec": exec_line % {"i": i}, "profile_key": profile_key}
+            filename = "webapp-Bench%d.desktop" % i
+        else:
+            content = APPLICATION_LAUNCHER % {"i": i}
+            filename = "application-%d.desktop" % i
+        with open(os.path.join(directory, filename), 'w') as desktop_file:
+            desktop_file.write(content)
+    return directory
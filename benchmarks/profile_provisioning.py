@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# Compares the strategies used to create Firefox profiles from the template.
+#
+# For each strategy, a number of profiles is created in the target directory,
+# and the time it took and the disk space it used are reported.
+#  - reflink: reflink, then hardlink for read-only files, then copy (default)
+#  - hardlink: hardlink for read-only files, then copy
+#  - copy: regular copy (same as shutil.copytree)
+#
+# The template is first copied (read-only) into the target filesystem,
+# so reflinks and hardlinks are possible. Run it as a regular user,
+# root can write to read-only files so hardlinks would never be used.
+#
+# Usage: benchmarks/profile_provisioning.py [--profiles N] [--target DIR]
+import argparse
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT_DIR, "usr", "lib", "webapp-manager"))
+
+from common import clone_tree, CLONE_REFLINK, CLONE_HARDLINK, CLONE_COPY
+
+TEMPLATE_DIR = os.path.join(ROOT_DIR, "usr", "share", "webapp-manager", "firefox", "profile")
+STRATEGIES = [("reflink", (CLONE_REFLINK, CLONE_HARDLINK, CLONE_COPY)),
+              ("hardlink", (CLONE_HARDLINK, CLONE_COPY)),
+              ("copy", (CLONE_COPY,))]
+
+def get_used_space(path):
+    os.sync()
+    info = os.statvfs(path)
+    return (info.f_blocks - info.f_bfree) * info.f_frsize
+
+def make_read_only(directory):
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            os.chmod(path, os.stat(path).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Firefox profile provisioning strategies")
+    parser.add_argument("--profiles", type=int, default=100, help="number of profiles to create per strategy")
+    parser.add_argument("--target", default=None, help="directory to create the profiles in (on the filesystem to test)")
+    args = parser.parse_args()
+
+    target = tempfile.mkdtemp(prefix="webapp-manager-bench-", dir=args.target)
+    template = os.path.join(target, "template")
+    shutil.copytree(TEMPLATE_DIR, template)
+    make_read_only(template)
+
+    print("%d profiles per strategy in %s" % (args.profiles, target))
+    try:
+        for name, strategies in STRATEGIES:
+            directory = os.path.join(target, name)
+            os.makedirs(directory)
+            used = get_used_space(target)
+            counts = [0, 0, 0]
+            start = time.perf_counter()
+            for i in range(args.profiles):
+                for strategy, count in enumerate(clone_tree(template, os.path.join(directory, str(i)), strategies)):
+                    counts[strategy] += count
+            elapsed = time.perf_counter() - start
+            used = get_used_space(target) - used
+            print("%-9s %8.2f ms/profile  %10d bytes/profile  (files: %d reflinked, %d hardlinked, %d copied)" % (
+                  name, elapsed * 1000 / args.profiles, used / args.profiles, counts[CLONE_REFLINK], counts[CLONE_HARDLINK], counts[CLONE_COPY]))
+    finally:
+        shutil.rmtree(target)
+
+if __name__ == "__main__":
+    main()
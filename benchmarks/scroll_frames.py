@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# Measures frame times while scrolling the list of webapps.
+#
+# A temporary home directory is populated with synthetic launchers,
+# the main window is opened and scrolled from top to bottom, and the
+# interval between painted frames is reported. The run is done twice,
+# with and without the per-row cairo surface cache.
+#
+# Usage: GDK_SCALE=2 benchmarks/scroll_frames.py [number of webapps]
+#
+# The window uses the installed UI files (/usr/share/webapp-manager)
+# and the gsettings schema, run ./test once before using this script.
+import importlib.util
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from launchers import create_launchers
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "webapp-manager")
+SCROLL_STEP = 40 # pixels per frame
+
+def run(module, cached):
+    from gi.repository import Gtk, GLib
+
+    window_class = module.WebAppManagerWindow
+    original = window_class.data_func_surface
+    if not cached:
+        def data_func_surface(self, column, cell, model, iter_, *args):
+            pixbuf = model.get_value(iter_, module.COL_ICON)
+            surface = module.Gdk.cairo_surface_create_from_pixbuf(pixbuf, self.window.get_scale_factor())
+            cell.set_property("surface", surface)
+        window_class.data_func_surface = data_func_surface
+
+    application = Gtk.Application()
+    manager_window = window_class(application)
+    window = manager_window.window
+    window.set_default_size(600, 800)
+    window.show()
+    adjustment = manager_window.treeview.get_vadjustment()
+    frame_times = []
+    state = {"last": None}
+
+    def on_after_paint(clock):
+        now = clock.get_frame_time()
+        if state["last"] != None:
+            frame_times.append((now - state["last"]) / 1000)
+        state["last"] = now
+
+    def scroll(widget, clock):
+        value = adjustment.get_value() + SCROLL_STEP
+        if value >= adjustment.get_upper() - adjustment.get_page_size():
+            Gtk.main_quit()
+            return GLib.SOURCE_REMOVE
+        adjustment.set_value(value)
+        return GLib.SOURCE_CONTINUE
+
+    def start():
+        window.get_frame_clock().connect("after-paint", on_after_paint)
+        manager_window.treeview.add_tick_callback(scroll)
+        return GLib.SOURCE_REMOVE
+
+    # Give icons a chance to load before scrolling
+    GLib.timeout_add(2000, start)
+    Gtk.main()
+    window.destroy()
+    window_class.data_func_surface = original
+    return frame_times
+
+def main():
+    num_webapps = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    home = tempfile.mkdtemp(prefix="webapp-manager-bench-")
+    os.environ["HOME"] = home
+    create_launchers(os.path.join(home, ".local", "share", "applications"), num_webapps, webapp_ratio=1)
+
+    sys.path.insert(0, LIB_DIR)
+    spec = importlib.util.spec_from_file_location("webapp_manager", os.path.join(LIB_DIR, "webapp-manager.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    print("%d webapps, scale factor %s" % (num_webapps, os.environ.get("GDK_SCALE", "1")))
+    for cached in [False, True]:
+        frame_times = run(module, cached)
+        if len(frame_times) < 2:
+            print("Not enough frames were painted")
+            continue
+        frame_times.sort()
+        print("%-16s frames: %5d  mean: %6.2f ms  p95: %6.2f ms  max: %6.2f ms" % (
+              "cached surfaces" if cached else "uncached", len(frame_times),
+              statistics.mean(frame_times), frame_times[int(len(frame_times) * 0.95)], frame_times[-1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# Cold-start benchmark of the application.
+#
+# Each run starts a fresh interpreter which imports the application
+# and opens the main window, and reports:
+#  - import: time spent importing webapp-manager.py (and common.py)
+#  - show: time until the main window is first drawn
+# Both are measured from the start of the interpreter.
+#
+# The median of all runs is compared against a budget, the script
+# exits with an error if it's exceeded, so it can be tracked between releases.
+#
+# Usage: benchmarks/startup.py [--runs N] [--max-import MS] [--max-show MS] [--webapps N]
+#
+# The window uses the installed UI files (/usr/share/webapp-manager)
+# and the gsettings schema, run ./test once before using this script.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from launchers import create_launchers
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "usr", "lib", "webapp-manager")
+
+# Default budget, in milliseconds
+MAX_IMPORT_TIME = 250
+MAX_SHOW_TIME = 800
+
+CHILD_SCRIPT = """
+import time
+start = time.perf_counter()
+import importlib.util, json, sys
+sys.path.insert(0, %(lib_dir)r)
+spec = importlib.util.spec_from_file_location("webapp_manager", %(path)r)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+from gi.repository import Gtk
+
+def on_draw(widget, context):
+    shown = time.perf_counter()
+    print(json.dumps({"import": (imported - start) * 1000, "show": (shown - start) * 1000,
+                      "modules": sorted(name for name in ["PIL", "requests", "tldextract"] if name in sys.modules)}))
+    Gtk.main_quit()
+    return False
+
+window = module.WebAppManagerWindow(Gtk.Application())
+window.window.connect_after("draw", on_draw)
+window.window.show()
+Gtk.main()
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold-start time of the application")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--webapps", type=int, default=200, help="number of synthetic webapps")
+    parser.add_argument("--max-import", type=float, default=MAX_IMPORT_TIME, help="import time budget (ms)")
+    parser.add_argument("--max-show", type=float, default=MAX_SHOW_TIME, help="time to first draw budget (ms)")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix="webapp-manager-bench-")
+    create_launchers(os.path.join(home, ".local", "share", "applications"), args.webapps, webapp_ratio=1)
+    env = dict(os.environ, HOME=home)
+    script = CHILD_SCRIPT % {"lib_dir": LIB_DIR, "path": os.path.join(LIB_DIR, "webapp-manager.py")}
+
+    results = []
+    for i in range(args.runs):
+        output = subprocess.run([sys.executable, "-c", script], env=env, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    import_time = statistics.median(result["import"] for result in results)
+    show_time = statistics.median(result["show"] for result in results)
+    print("import: %.1f ms (budget %.0f ms)" % (import_time, args.max_import))
+    print("show:   %.1f ms (budget %.0f ms)" % (show_time, args.max_show))
+    if len(results[-1]["modules"]) > 0:
+        print("modules loaded at startup which should be lazy: %s" % ", ".join(results[-1]["modules"]))
+
+    if import_time > args.max_import or show_time > args.max_show:
+        print("Startup budget exceeded")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
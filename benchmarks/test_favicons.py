@@ -0,0 +1,55 @@
+# Benchmarks of the favicon search, against a local stand-in for websites (see favicon_server.py)
+import time
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+pytest.importorskip("PIL")
+pytest.importorskip("requests")
+common = pytest.importorskip("common")
+
+from favicon_server import FaviconServer, SLOW_DELAY
+
+ROUNDS = 10
+SLOW_TIMEOUT = 1 # seconds, below SLOW_DELAY
+
+@pytest.fixture(scope="module")
+def server():
+    server = FaviconServer()
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture(autouse=True)
+def no_external_sources(monkeypatch):
+    # Only the local server is queried
+    monkeypatch.setattr(common, "get_favicon_grabber_links", lambda netloc, deadline: [])
+
+# All the sites share the same domain (netloc), so the cache is emptied before each search
+def purge_cache():
+    common.get_favicon_cache().purge()
+
+@pytest.mark.parametrize("site", ["fast", "large", "huge"])
+def test_download_favicon(benchmark, server, site):
+    images = benchmark.pedantic(common.download_favicon, args=(server.get_url(site),), setup=purge_cache, rounds=ROUNDS)
+    # The ICO counts as one image (its biggest frame), the huge og:image is ignored
+    assert len(images) == (2 if site == "huge" else 3)
+
+# The search stops at its deadline when the site is slow
+def test_download_favicon_slow(benchmark, server):
+    durations = []
+    def download():
+        start = time.monotonic()
+        images = common.download_favicon(server.get_url("slow"), timeout=SLOW_TIMEOUT)
+        durations.append(time.monotonic() - start)
+        return images
+    images = benchmark.pedantic(download, setup=purge_cache, rounds=3)
+    assert images == []
+    assert max(durations) < SLOW_DELAY
+
+# Fresh cache entries cost no request
+def test_download_favicon_cached(benchmark, server):
+    purge_cache()
+    common.download_favicon(server.get_url("fast"))
+    images = benchmark(common.download_favicon, server.get_url("fast"))
+    assert len(images) == 3
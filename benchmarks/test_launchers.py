@@ -0,0 +1,76 @@
+# Benchmarks of the launchers: scanning, parsing, creating and deleting webapps
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+common = pytest.importorskip("common")
+
+from conftest import HOME_DIR
+
+SIZES = [100, 1000, 10000]
+BROWSERS = [common.Browser(common.BROWSER_TYPE_FIREFOX, "Firefox", "firefox", "/usr/bin/firefox"),
+            common.Browser(common.BROWSER_TYPE_CHROMIUM, "Chromium", "chromium", "/usr/bin/chromium"),
+            common.Browser(common.BROWSER_TYPE_EPIPHANY, "Epiphany", "epiphany", "/usr/bin/epiphany-browser")]
+BROWSER_IDS = ["firefox", "chromium", "epiphany"]
+ROUNDS = 50
+
+# Webapp names are unique, so the random codenames of their profiles never collide
+def get_webapp_name():
+    global webapp_count
+    webapp_count += 1
+    return "Bench" + "".join(chr(ord("a") + int(digit)) for digit in str(webapp_count))
+
+webapp_count = 0
+
+def get_index_path():
+    (fd, path) = tempfile.mkstemp(prefix="launchers-", suffix=".json", dir=HOME_DIR)
+    os.close(fd)
+    os.remove(path)
+    return path
+
+# First scan, every launcher is parsed
+@pytest.mark.parametrize("num_launchers", SIZES)
+def test_scan_cold(benchmark, apps_dirs, num_launchers):
+    directory = apps_dirs(num_launchers)
+    def setup():
+        return (common.LauncherIndex(get_index_path()),), {}
+    launchers = benchmark.pedantic(lambda index: index.scan(directory), setup=setup, rounds=5)
+    assert len(launchers) == (num_launchers + 3) // 4
+
+# Following scans (what get_webapps() costs at startup), launchers are loaded from the index
+@pytest.mark.parametrize("num_launchers", SIZES)
+def test_get_webapps(benchmark, monkeypatch, manager, apps_dirs, num_launchers):
+    monkeypatch.setattr(common, "APPS_DIR", apps_dirs(num_launchers))
+    manager.index = common.LauncherIndex(get_index_path())
+    manager.get_webapps()
+    launchers = benchmark(manager.get_webapps)
+    assert len(launchers) == (num_launchers + 3) // 4
+
+@pytest.mark.parametrize("filename", ["webapp-Bench0.desktop", "webapp-Bench4.desktop", "webapp-Bench8.desktop"],
+                         ids=BROWSER_IDS)
+def test_read_launcher(benchmark, apps_dirs, filename):
+    path = os.path.join(apps_dirs(100), filename)
+    launcher = benchmark(common.read_launcher, path)
+    assert launcher != None and launcher.url != None
+
+# Regular applications are rejected without being decoded
+def test_read_launcher_non_webapp(benchmark, apps_dirs):
+    path = os.path.join(apps_dirs(100), "application-1.desktop")
+    assert benchmark(common.read_launcher, path) == None
+
+@pytest.mark.parametrize("browser", BROWSERS, ids=BROWSER_IDS)
+def test_create_webapp(benchmark, manager, browser):
+    def setup():
+        return (get_webapp_name(), "https://bench.example.com", "webapp-manager", "WebApps", browser), {}
+    path = benchmark.pedantic(manager.create_webapp, setup=setup, rounds=ROUNDS)
+    assert manager.get_webapp(path) != None
+
+@pytest.mark.parametrize("browser", BROWSERS, ids=BROWSER_IDS)
+def test_delete_webapp(benchmark, manager, browser):
+    def setup():
+        path = manager.create_webapp(get_webapp_name(), "https://bench.example.com", "webapp-manager", "WebApps", browser)
+        return (manager.get_webapp(path),), {}
+    benchmark.pedantic(manager.delete_webbapp, setup=setup, rounds=ROUNDS)
+    manager.empty_trash().result()
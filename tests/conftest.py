@@ -0,0 +1,13 @@
+# Unit tests of common.py (needs pytest and PyGObject).
+#
+# common.py computes its paths (APPS_DIR, ICE_DIR...) from $HOME when it's
+# imported, so the tests run in a temporary home directory.
+#
+# Usage: make test
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+os.environ["HOME"] = tempfile.mkdtemp(prefix="webapp-manager-test-")
+sys.path.insert(0, os.path.join(ROOT_DIR, "usr", "lib", "webapp-manager"))
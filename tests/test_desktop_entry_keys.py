@@ -0,0 +1,47 @@
+# Launchers are edited line by line, everything but the edited keys is kept as it is
+import pytest
+
+common = pytest.importorskip("common")
+from common import set_desktop_entry_keys
+
+LAUNCHER = """# Created by hand
+[Desktop Entry]
+Name=Mail
+Name[fr]=Courrier
+Icon=mail
+# Keep the browser
+Exec=chromium --app=https://mail.example.com
+Categories=GTK;Network;
+
+[Desktop Action compose]
+Name=Compose
+Icon=compose
+"""
+
+def test_existing_keys():
+    content = set_desktop_entry_keys(LAUNCHER, [("Name", "Webmail"), ("Icon", "/icons/webmail.png")])
+    assert content == LAUNCHER.replace("Name=Mail\n", "Name=Webmail\n").replace("Icon=mail\n", "Icon=/icons/webmail.png\n")
+
+# Other groups (actions) and localized keys aren't modified
+def test_other_groups_and_locales():
+    content = set_desktop_entry_keys(LAUNCHER, [("Name", "Webmail"), ("Icon", "webmail")])
+    assert "Name[fr]=Courrier\n" in content
+    assert "[Desktop Action compose]\nName=Compose\nIcon=compose\n" in content
+
+# Missing keys are added at the end of the group, before the next one
+def test_missing_keys():
+    content = set_desktop_entry_keys(LAUNCHER, [("Categories", "GTK;Office;"), ("Comment", "Webmail")])
+    assert "Categories=GTK;Office;\nComment=Webmail\n\n[Desktop Action compose]" in content
+    assert content.count("Categories=") == 1
+
+def test_spaces_around_separator():
+    content = set_desktop_entry_keys("[Desktop Entry]\nName = Mail\nIcon=mail\n", [("Name", "Webmail")])
+    assert content == "[Desktop Entry]\nName=Webmail\nIcon=mail\n"
+
+def test_missing_group():
+    assert set_desktop_entry_keys("", [("Name", "Mail")]) == "[Desktop Entry]\nName=Mail\n"
+    assert set_desktop_entry_keys("# Comment\n", [("Name", "Mail")]) == "[Desktop Entry]\nName=Mail\n# Comment\n"
+    assert set_desktop_entry_keys("[Desktop Entry]\n", [("Name", "Mail")]) == "[Desktop Entry]\nName=Mail\n"
+
+def test_trailing_newline():
+    assert set_desktop_entry_keys("[Desktop Entry]\nName=Mail", [("Icon", "mail")]) == "[Desktop Entry]\nName=Mail\nIcon=mail\n"
@@ -0,0 +1,120 @@
+# The icons of a page are read from the links and metas of its <head>
+import pytest
+
+common = pytest.importorskip("common")
+from common import PageIconParser, parse_page_links, PAGE_CHUNK_SIZE, PAGE_MAX_SIZE
+
+BASE_URL = "https://example.com/app/index.html"
+
+def get_links(page, base_url=BASE_URL):
+    parser = PageIconParser(base_url)
+    parser.feed(page)
+    return parser.links
+
+# Streamed response, records the chunks that were read
+class FakeResponse():
+
+    def __init__(self, content, url=BASE_URL, headers=None, encoding="UTF-8"):
+        self.content = content
+        self.url = url
+        self.headers = headers or {}
+        self.encoding = encoding
+        self.status_code = 200
+        self.read = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            chunk = self.content[start:start + chunk_size]
+            self.read += len(chunk)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+def test_rel_tokens():
+    links = get_links("""<head>
+<link rel="shortcut icon" href="/favicon.ico">
+<link rel="Apple-Touch-Icon" href="touch.png">
+<link rel="stylesheet" href="style.css">
+<link rel="iconic" href="iconic.png">
+<link rel="icon">
+</head>""")
+    assert links == [
+        ["shortcut icon", "https://example.com/favicon.ico"],
+        ["apple-touch-icon", "https://example.com/app/touch.png"],
+    ]
+
+def test_sizes_variants():
+    links = get_links("""<head>
+<link rel="icon" sizes="16x16" href="icon-16.png">
+<link rel="icon" sizes="32x32" href="icon-32.png">
+<link rel="icon" sizes="any" href="icon.svg">
+<link rel="icon" href="icon.png">
+</head>""")
+    assert links == [
+        ["icon 16x16", "https://example.com/app/icon-16.png"],
+        ["icon 32x32", "https://example.com/app/icon-32.png"],
+        ["icon any", "https://example.com/app/icon.svg"],
+        ["icon", "https://example.com/app/icon.png"],
+    ]
+
+def test_base_href():
+    links = get_links("""<head>
+<link rel="icon" href="before.png">
+<base href="https://static.example.org/assets/">
+<link rel="icon" href="after.png">
+</head>""")
+    assert links == [
+        ["icon", "https://example.com/app/before.png"],
+        ["icon", "https://static.example.org/assets/after.png"],
+    ]
+
+def test_metas():
+    links = get_links("""<head>
+<meta property="og:image" content="https://cdn.example.com/og.png">
+<meta name="msapplication-TileImage" content="/tile.png">
+<meta name="description" content="not an icon">
+<meta property="og:image">
+</head>""")
+    assert links == [
+        ["og:image", "https://cdn.example.com/og.png"],
+        ["msapplication-tileimage", "https://example.com/tile.png"],
+    ]
+
+@pytest.mark.parametrize("end", ["</head>", "<body>"])
+def test_end_of_head(end):
+    parser = PageIconParser(BASE_URL)
+    parser.feed('<html><link rel="icon" href="head.png">%s<link rel="icon" href="body.png">' % end)
+    assert parser.done
+    assert parser.links == [["icon", "https://example.com/app/head.png"]]
+
+def test_parse_page_links():
+    response = FakeResponse(b'<head><link rel="icon" href="icon.png"></head>',
+                            headers={"ETag": '"1234"', "Last-Modified": "Tue, 13 Oct 2026 10:00:00 GMT"})
+    validators = {}
+    links = parse_page_links(response, validators)
+    assert links == [["icon", "https://example.com/app/icon.png"]]
+    assert validators == {"etag": '"1234"', "last_modified": "Tue, 13 Oct 2026 10:00:00 GMT"}
+    assert response.closed
+
+# The rest of the page isn't downloaded once the <head> is parsed
+def test_stops_after_head():
+    content = b'<head><link rel="icon" href="icon.png"></head>'
+    content = content.ljust(PAGE_CHUNK_SIZE, b" ") + b"x" * PAGE_MAX_SIZE
+    response = FakeResponse(content)
+    assert parse_page_links(response, {}) == [["icon", "https://example.com/app/icon.png"]]
+    assert response.read == PAGE_CHUNK_SIZE
+    assert response.closed
+
+# Pages without an end of <head> are only read up to PAGE_MAX_SIZE
+def test_max_size():
+    content = b"<head>" + b"<!-- padding -->" * PAGE_MAX_SIZE + b'<link rel="icon" href="late.png">'
+    response = FakeResponse(content)
+    assert parse_page_links(response, {}) == []
+    assert PAGE_MAX_SIZE <= response.read < PAGE_MAX_SIZE + PAGE_CHUNK_SIZE
+    assert response.closed
+
+def test_unknown_encoding():
+    response = FakeResponse(b'<head><link rel="icon" href="ic\xc3\xb4ne.png"></head>', encoding="x-unknown")
+    assert parse_page_links(response, {}) == [["icon", "https://example.com/app/icône.png"]]
@@ -0,0 +1,71 @@
+# Exec lines are split as described in the desktop entry specification
+import pytest
+
+common = pytest.importorskip("common")
+from common import parse_exec, quote_exec_argument, set_launch_url, get_chromium_cache_args, set_chromium_cache_args
+
+def test_plain_arguments():
+    assert parse_exec("chromium --app=https://example.com  --class=ICE-SSB-Mail") == \
+        ("chromium", "--app=https://example.com", "--class=ICE-SSB-Mail")
+
+# URLs are written unquoted, their reserved characters are kept
+def test_unquoted_reserved_characters():
+    assert parse_exec("firefox https://example.com/?a=1&b=2#top") == ("firefox", "https://example.com/?a=1&b=2#top")
+
+def test_quoted_arguments():
+    assert parse_exec('epiphany --profile="/home/user/my profile" https://example.com') == \
+        ("epiphany", "--profile=/home/user/my profile", "https://example.com")
+    assert parse_exec('browser "" end') == ("browser", "", "end")
+
+# Inside quotes, \" \` \$ and \\ are escaped (and the backslash is escaped once more at the string level)
+def test_quoted_escapes():
+    assert parse_exec(r'browser "a\\"b" "c\\$d" "e\\`f" "g\\\\h"') == ("browser", 'a"b', "c$d", "e`f", "g\\h")
+
+def test_string_escapes():
+    assert parse_exec(r"browser a\sb") == ("browser", "a", "b")
+    assert parse_exec(r'browser "a\sb" "c\\d"') == ("browser", "a b", "c\\d")
+
+def test_field_codes():
+    assert parse_exec("browser 100%% %U %u %F %f") == ("browser", "100%")
+    assert parse_exec('browser "50%% off"') == ("browser", "50% off")
+    assert parse_exec("browser %i --name=%c %k", "Mail", "mail-icon", "/apps/mail.desktop") == \
+        ("browser", "--icon", "mail-icon", "--name=Mail", "/apps/mail.desktop")
+    # %i is removed when the launcher has no icon
+    assert parse_exec("browser %i url", "Mail", None, None) == ("browser", "url")
+    # Deprecated field codes are removed
+    assert parse_exec("browser %d %D %n %N %v %m url") == ("browser", "url")
+
+def test_unterminated_quote():
+    with pytest.raises(ValueError):
+        parse_exec('browser "https://example.com')
+    with pytest.raises(ValueError):
+        parse_exec(r'browser "a\\"')
+
+# The result is cached, it can't be modified by a caller
+def test_cached_result_is_immutable():
+    argv = parse_exec("browser --app=https://example.com")
+    assert isinstance(argv, tuple)
+    assert parse_exec("browser --app=https://example.com") is argv
+
+@pytest.mark.parametrize("argument", ["plain", "/home/user/shared cache/Mail1234", "100%", "50% off", "back\\slash",
+                                      'double"quote', "$HOME", "`command`", "new\nline", "", "a;b", "~/cache"])
+def test_quote_exec_argument(argument):
+    assert parse_exec("browser %s" % quote_exec_argument(argument)) == ("browser", argument)
+
+def test_set_launch_url():
+    assert set_launch_url("chromium --app=https://old.example.com --class=ICE-SSB-Mail", "https://new.example.com/?a=1&b=2") == \
+        "chromium --app=https://new.example.com/?a=1&b=2 --class=ICE-SSB-Mail"
+    assert set_launch_url("firefox --class ICE-SSB-Docs --profile /p --no-remote https://old.example.com", "https://new.example.com") == \
+        "firefox --class ICE-SSB-Docs --profile /p --no-remote https://new.example.com"
+    with pytest.raises(ValueError):
+        set_launch_url("browser --no-url", "https://example.com")
+
+# The cache arguments are replaced, whether they're quoted or not
+@pytest.mark.parametrize("directory", ["/run/user/1000/webapp-manager/Mail1234", '/home/user/my "cache"/Mail1234', "/home/user/back\\slash/Mail1234"])
+def test_set_chromium_cache_args(directory):
+    exec_line = "chromium --app=https://example.com --user-data-dir=/p" + get_chromium_cache_args(directory, 50)
+    assert parse_exec(exec_line)[-2:] == ("--disk-cache-dir=" + directory, "--disk-cache-size=52428800")
+    exec_line = set_chromium_cache_args(exec_line, "/cache/Mail1234", 100)
+    assert parse_exec(exec_line) == ("chromium", "--app=https://example.com", "--user-data-dir=/p",
+                                     "--disk-cache-dir=/cache/Mail1234", "--disk-cache-size=104857600")
+    assert set_chromium_cache_args(exec_line, None, 100) == "chromium --app=https://example.com --user-data-dir=/p"
@@ -0,0 +1,114 @@
+# Launchers are parsed as bytes, only the keys of the [Desktop Entry] group are read
+import pytest
+
+common = pytest.importorskip("common")
+from common import read_launcher, BROWSER_TYPE_CHROMIUM, BROWSER_TYPE_EPIPHANY, BROWSER_TYPE_FIREFOX
+
+CHROMIUM_LAUNCHER = """[Desktop Entry]
+Version=1.0
+GenericName=Web Browser
+Name[fr]=Courrier
+Name=Mail
+Comment=Mail (Web App)
+Exec=chromium --app=https://mail.example.com --class=ICE-SSB-Mail1234 --user-data-dir=/profiles/Mail1234
+X-ICE-SSB-Profile=Mail1234
+Type=Application
+Icon=mail
+Categories=GTK;Network;
+StartupWMClass=ICE-SSB-Mail1234
+
+[Desktop Action compose]
+Name=Compose
+Icon=compose
+Exec=chromium --app=https://mail.example.com/compose
+"""
+
+def write_launcher(tmp_path, content, newline="\n"):
+    path = tmp_path / "webapp-Mail1234.desktop"
+    path.write_bytes(content.replace("\n", newline).encode("UTF-8"))
+    return str(path)
+
+def test_chromium(tmp_path):
+    launcher = read_launcher(write_launcher(tmp_path, CHROMIUM_LAUNCHER))
+    assert launcher.browser_type == BROWSER_TYPE_CHROMIUM
+    assert launcher.profile == "Mail1234"
+    assert launcher.is_isolated
+    assert launcher.url == "https://mail.example.com"
+    assert launcher.category == "Network"
+
+# GenericName= and Name[fr]= aren't taken for Name=
+def test_similar_keys(tmp_path):
+    launcher = read_launcher(write_launcher(tmp_path, CHROMIUM_LAUNCHER))
+    assert launcher.name == "Mail"
+
+# The keys of the actions don't override the ones of the webapp
+def test_action_groups(tmp_path):
+    launcher = read_launcher(write_launcher(tmp_path, CHROMIUM_LAUNCHER))
+    assert launcher.icon == "mail"
+    assert launcher.exec.startswith("chromium --app=https://mail.example.com --class")
+
+# A launcher is only a webapp if the marker is in its [Desktop Entry] group
+def test_marker_in_another_group(tmp_path):
+    content = """[Desktop Entry]
+Name=Editor
+Icon=editor
+Exec=editor
+Type=Application
+
+[Desktop Action web]
+Name=Web
+StartupWMClass=ICE-SSB-Editor
+"""
+    assert read_launcher(write_launcher(tmp_path, content)) == None
+
+def test_regular_application(tmp_path):
+    content = "[Desktop Entry]\nName=Editor\nIcon=editor\nExec=editor %U\nType=Application\n"
+    assert read_launcher(write_launcher(tmp_path, content)) == None
+
+def test_crlf(tmp_path):
+    launcher = read_launcher(write_launcher(tmp_path, CHROMIUM_LAUNCHER, newline="\r\n"))
+    assert launcher.name == "Mail"
+    assert launcher.icon == "mail"
+    assert launcher.profile == "Mail1234"
+    assert launcher.category == "Network"
+
+@pytest.mark.parametrize("key", ["Name", "Icon"])
+def test_missing_keys(tmp_path, key):
+    content = "\n".join(line for line in CHROMIUM_LAUNCHER.split("\n") if not line.startswith(key + "="))
+    assert read_launcher(write_launcher(tmp_path, content)) == None
+
+def test_firefox(tmp_path):
+    content = """[Desktop Entry]
+Name=Docs
+Exec=firefox --class ICE-SSB-Docs1234 --profile /firefox/Docs1234 --no-remote https://docs.example.com
+IceFirefox=Docs1234
+Icon=docs
+Categories=GTK;Office;
+StartupWMClass=ICE-SSB-Docs1234
+"""
+    launcher = read_launcher(write_launcher(tmp_path, content))
+    assert launcher.browser_type == BROWSER_TYPE_FIREFOX
+    assert launcher.profile == "Docs1234"
+    assert launcher.url == "https://docs.example.com"
+
+def test_epiphany(tmp_path):
+    content = """[Desktop Entry]
+Name=Chat
+Exec=epiphany --application-mode --profile="/epiphany/epiphany-Chat1234" https://chat.example.com
+IceEpiphany=Chat1234
+Icon=chat
+Categories=GTK;Network;
+StartupWMClass=ICE-SSB-Chat1234
+"""
+    launcher = read_launcher(write_launcher(tmp_path, content))
+    assert launcher.browser_type == BROWSER_TYPE_EPIPHANY
+    assert launcher.profile == "Chat1234"
+    assert launcher.url == "https://chat.example.com"
+
+# Chromium webapps without their own profile
+def test_chromium_not_isolated(tmp_path):
+    content = CHROMIUM_LAUNCHER.replace("X-ICE-SSB-Profile=Mail1234\n", "")
+    launcher = read_launcher(write_launcher(tmp_path, content))
+    assert launcher.browser_type == BROWSER_TYPE_CHROMIUM
+    assert launcher.profile == None
+    assert not launcher.is_isolated
@@ -1,28 +1,269 @@
 #!/usr/bin/python3
-import configparser
+import atexit
+import concurrent.futures
+import contextlib
+import fcntl
+import filecmp
+import functools
 import gi
+import hashlib
+import json
 import os
+import queue
+import re
 import shutil
+import stat
 import string
+import subprocess
+import sys
 import threading
+import time
 from gi.repository import GObject
 from random import choice
 
-# Used as a decorator to run things in the background
+# Used as a decorator to run things in the background (in the shared task executor).
+# Returns a concurrent.futures.Future, errors are printed since nobody may wait for it.
 def _async(func):
     def wrapper(*args, **kwargs):
-        thread = threading.Thread(target=func, args=args, kwargs=kwargs)
-        thread.daemon = True
-        thread.start()
-        return thread
+        future = get_task_executor().submit(func, *args, **kwargs)
+        future.add_done_callback(print_future_error)
+        return future
     return wrapper
 
+def print_future_error(future):
+    if not future.cancelled() and future.exception() != None:
+        print(future.exception())
+
 # Used as a decorator to run things in the main loop, from another thread
 def idle(func):
     def wrapper(*args):
         GObject.idle_add(func, *args)
     return wrapper
 
+# Opt-in tracing, enabled with WEBAPP_MANAGER_TRACE=<path of the trace> (or 1 for a file in /tmp)
+# or with the "trace" gsetting. Spans are written as Chrome trace events (chrome://tracing,
+# ui.perfetto.dev) when the application exits, and a summary is printed on stderr.
+TRACE_ENV = "WEBAPP_MANAGER_TRACE"
+
+class TraceSpan():
+
+    __slots__ = ("tracer", "name", "category", "args", "start")
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    # Records a result of the span (status, size...)
+    def set(self, key, value):
+        self.args[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type != None:
+            self.args["error"] = str(exc_value)
+        self.tracer.add_event(self, time.perf_counter())
+        return False
+
+# Used when tracing is disabled, so spans cost next to nothing
+class NullSpan():
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class Tracer():
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.null_span = NullSpan()
+
+    def enable(self, path=None):
+        if self.enabled:
+            return
+        if path == None or path == "1":
+            import tempfile
+            path = os.path.join(tempfile.gettempdir(), "webapp-manager-trace-%d.json" % os.getpid())
+        self.path = path
+        self.enabled = True
+        atexit.register(self.finish)
+
+    def span(self, name, category, **args):
+        if not self.enabled:
+            return self.null_span
+        return TraceSpan(self, name, category, args)
+
+    # Counters are shown as graphs in the trace
+    def add_counter(self, name, values):
+        event = {"name": name, "ph": "C", "pid": os.getpid(), "ts": (time.perf_counter() - self.origin) * 1000000, "args": values}
+        with self.lock:
+            self.events.append(event)
+
+    def add_event(self, span, end):
+        event = {"name": span.name, "cat": span.category, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                 "ts": (span.start - self.origin) * 1000000, "dur": (end - span.start) * 1000000, "args": span.args}
+        with self.lock:
+            self.events.append(event)
+
+    # Writes the trace and prints the time spent in each kind of span
+    def finish(self):
+        with self.lock:
+            events = list(self.events)
+        try:
+            with open(self.path, 'w') as trace_file:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file, default=str)
+        except Exception as e:
+            print(e)
+        totals = {}
+        for event in events:
+            if event["ph"] != "X":
+                continue
+            total = totals.setdefault((event["cat"], event["name"]), [0, 0, 0])
+            total[0] += 1
+            total[1] += event["dur"]
+            total[2] = max(total[2], event["dur"])
+        print("Trace written to %s" % self.path, file=sys.stderr)
+        print("%-12s %-20s %8s %12s %12s %12s" % ("category", "span", "count", "total (ms)", "mean (ms)", "max (ms)"), file=sys.stderr)
+        for (category, name), (count, duration, longest) in sorted(totals.items(), key=lambda x: x[1][1], reverse=True):
+            print("%-12s %-20s %8d %12.2f %12.2f %12.2f" % (category, name, count, duration / 1000, duration / 1000 / count, longest / 1000),
+                  file=sys.stderr)
+        for executor in task_executors:
+            stats = executor.get_stats()
+            print("Background %s: %d/%d workers, %d queued, %d running, %.1f%% utilisation" % (
+                  executor.name, stats["workers"], stats["max_workers"], stats["queued"], stats["running"], stats["utilisation"] * 100),
+                  file=sys.stderr)
+
+tracer = Tracer()
+if os.environ.get(TRACE_ENV):
+    tracer.enable(os.environ[TRACE_ENV])
+
+TASK_WORKERS = 6
+
+# Cancellation token of a background task.
+# Long tasks check it between steps, and callbacks in the main loop ignore the results of cancelled tasks.
+class CancellationToken():
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.future = None
+
+    def cancel(self):
+        self.event.set()
+        if self.future != None:
+            # Tasks which haven't started yet never run
+            self.future.cancel()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+# Bounded pool of background threads (see get_task_executor() for the one shared by the whole application).
+# Threads are started on demand (up to max_workers) and they're daemons,
+# so pending tasks never prevent the application from exiting.
+class TaskExecutor():
+
+    def __init__(self, max_workers=TASK_WORKERS, name="tasks"):
+        self.max_workers = max_workers
+        self.name = name
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.idle_workers = 0
+        self.queued = 0
+        self.running = 0
+        self.busy_time = 0
+        self.start_time = time.monotonic()
+        self.latest = {} # key -> CancellationToken of the latest task submitted with submit_latest()
+        task_executors.append(self)
+
+    def submit(self, func, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.queued += 1
+            if self.idle_workers == 0 and len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self.work, name="webapp-manager-%s-%d" % (self.name, len(self.threads)))
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+            else:
+                self.idle_workers -= 1
+        self.update_counters()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    # Runs func(token, *args), and cancels the previous task submitted with the same key.
+    # Returns the token, which tells the callbacks of the task whether its results are still wanted.
+    def submit_latest(self, key, func, *args, **kwargs):
+        token = CancellationToken()
+        with self.lock:
+            previous = self.latest.get(key)
+            self.latest[key] = token
+        if previous != None:
+            previous.cancel()
+        token.future = self.submit(func, token, *args, **kwargs)
+        return token
+
+    def cancel(self, key):
+        with self.lock:
+            token = self.latest.pop(key, None)
+        if token != None:
+            token.cancel()
+
+    def work(self):
+        while True:
+            (future, func, args, kwargs) = self.queue.get()
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+            self.update_counters()
+            start = time.monotonic()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self.lock:
+                self.running -= 1
+                self.busy_time += time.monotonic() - start
+                self.idle_workers += 1
+            self.update_counters()
+
+    def update_counters(self):
+        if tracer.enabled:
+            tracer.add_counter(self.name, {"queued": self.queued, "running": self.running})
+
+    # Queue depth and utilisation of the workers, for diagnostics
+    def get_stats(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            return {"workers": len(self.threads), "max_workers": self.max_workers,
+                    "queued": self.queued, "running": self.running,
+                    "utilisation": self.busy_time / (self.max_workers * elapsed) if elapsed > 0 else 0}
+
+task_executors = [] # every executor, for the trace summary
+task_executor = None
+task_executor_lock = threading.Lock()
+
+def get_task_executor():
+    global task_executor
+    with task_executor_lock:
+        if task_executor == None:
+            task_executor = TaskExecutor()
+        return task_executor
+
 # Constants
 ICE_DIR = os.path.expanduser("~/.local/share/ice")
 APPS_DIR = os.path.expanduser("~/.local/share/applications")
@@ -30,7 +271,40 @@ PROFILES_DIR = os.path.join(ICE_DIR, "profiles")
 FIREFOX_PROFILES_DIR = os.path.join(ICE_DIR, "firefox")
 EPIPHANY_PROFILES_DIR = os.path.join(ICE_DIR, "epiphany")
 ICONS_DIR = os.path.join(ICE_DIR, "icons")
+LAUNCHER_INDEX = os.path.join(ICE_DIR, "launchers.json")
+THUMBNAILS_DIR = os.path.join(ICE_DIR, "thumbnails")
+FAVICONS_DIR = os.path.join(ICE_DIR, "favicons")
+TRASH_DIR = os.path.join(ICE_DIR, ".trash")
+DISK_USAGE_INDEX = os.path.join(ICE_DIR, "usage.json")
+PREWARM_INDEX = os.path.join(ICE_DIR, "prewarm.json")
+SHARED_CACHE_DIR = os.path.expanduser("~/.cache/webapp-manager")
+FIREFOX_PROFILE_TEMPLATE = "/usr/share/webapp-manager/firefox/profile"
+FIREFOX_NAVBAR_CSS = "/usr/share/webapp-manager/firefox/userChrome-with-navbar.css"
 BROWSER_TYPE_FIREFOX, BROWSER_TYPE_CHROMIUM, BROWSER_TYPE_EPIPHANY = range(3)
+CLONE_REFLINK, CLONE_HARDLINK, CLONE_COPY = range(3)
+CACHE_LOCATION_PROFILE, CACHE_LOCATION_RUNTIME, CACHE_LOCATION_SHARED = ["profile", "runtime", "shared"]
+CACHE_SIZE = 256 # MB
+FICLONE = 0x40049409 # ioctl from linux/fs.h
+
+# Files read by the browsers when they start, used to prewarm profiles until
+# the files they actually use are learned (see PrewarmIndex)
+FIREFOX_HOT_FILES = ["prefs.js", "user.js", "times.json", "compatibility.ini", "extensions.json", "addonStartup.json.lz4",
+                     "search.json.mozlz4", "xulstore.json", "containers.json", "handlers.json", "sessionstore.jsonlz4",
+                     "places.sqlite", "favicons.sqlite", "cookies.sqlite", "permissions.sqlite", "content-prefs.sqlite",
+                     "webappsstore.sqlite", "storage.sqlite", "formhistory.sqlite", "cert9.db", "key4.db",
+                     "chrome/userChrome.css"]
+CHROMIUM_HOT_FILES = ["Local State", "Default/Preferences", "Default/Secure Preferences", "Default/History",
+                      "Default/Favicons", "Default/Web Data", "Default/Login Data", "Default/Cookies",
+                      "Default/Network/Cookies", "Default/Network Persistent State", "Default/Extension State/CURRENT",
+                      "Default/Local Storage/leveldb/CURRENT", "Default/Shortcuts", "Default/Top Sites"]
+PREWARM_MAX_FILES = 256
+PREWARM_MAX_SIZE = 256 * 1024 * 1024
+
+# Profile subdirectories which only contain caches, browsers regenerate them when needed
+# (Chromium keeps them in the user data dir or in its Default/Profile N dirs)
+PROFILE_CACHE_DIRS = ["Cache", "Code Cache", "GPUCache", "ShaderCache", "GrShaderCache", "GraphiteDawnCache",
+                      "DawnCache", "DawnGraphiteCache", "DawnWebGPUCache", "cache2", "startupCache", "thumbnails",
+                      "jumpListCache", "OfflineCache"]
 
 class Browser():
 
@@ -42,55 +316,680 @@ class Browser():
 
 # This is a data structure representing
 # the app menu item (path, name, icon..etc.)
+# Only valid webapps get a launcher, see read_launcher().
 class WebAppLauncher():
 
-    def __init__(self, path):
+    # Attributes stored in the launcher index
+    FIELDS = ("name", "icon", "exec", "category", "profile", "url", "browser_type")
+    __slots__ = ("path", "search_key") + FIELDS
+
+    is_webapp = True
+    is_valid = True
+
+    def __init__(self, path, fields):
         self.path = path
-        self.name = None
-        self.icon = None
-        self.profile = None
-        self.is_webapp = False
-        self.is_firefox = False
-        self.is_isolated = False
-        self.is_valid = False
-        self.exec = None
-        self.category = None
+        (self.name, self.icon, self.exec, self.category,
+         self.profile, self.url, self.browser_type) = fields
+        # Casefolded name, URL, category and browser, matched by the search of the main window
+        browser = os.path.basename(self.exec.split(" ", 1)[0]) if self.exec != None else ""
+        self.search_key = "\n".join([self.name, self.url or "", self.category or "", browser]).casefold()
 
-        with open(path) as desktop_file:
-            for line in desktop_file:
-                line = line.strip()
+    @property
+    def is_firefox(self):
+        return self.browser_type == BROWSER_TYPE_FIREFOX
 
-                # Identify if the app is a webapp (we use ICE-SSB to keep compatibility with ICE)
-                if "StartupWMClass=Chromium" in line or "StartupWMClass=ICE-SSB" in line:
-                    self.is_webapp = True
-                    continue
+    @property
+    def is_isolated(self):
+        return self.browser_type == BROWSER_TYPE_CHROMIUM and self.profile != None
 
-                if "Name=" in line:
-                    self.name = line.replace("Name=", "")
-                    continue
+    def get_fields(self):
+        return [getattr(self, key) for key in self.FIELDS]
 
-                if "Icon=" in line:
-                    self.icon = line.replace("Icon=", "")
-                    continue
+    # Command line of the webapp, without a shell (see parse_exec())
+    def get_argv(self):
+        return parse_exec(self.exec, self.name, self.icon, self.path)
 
-                if "Exec=" in line:
-                    self.exec = line.replace("Exec=", "")
-                    continue
+# Identifies webapps (we use ICE-SSB to keep compatibility with ICE)
+WEBAPP_MARKER = re.compile(rb"^[ \t]*StartupWMClass[ \t]*=[ \t]*(?:ICE-SSB|Chromium)", re.MULTILINE)
+DESKTOP_ENTRY_GROUP = re.compile(rb"^\[Desktop Entry\][^\n]*\n(.*?)(?=^\[|\Z)", re.MULTILINE | re.DOTALL)
+LAUNCHER_KEYS = {b"Name", b"Icon", b"Exec", b"Categories", b"IceFirefox", b"IceEpiphany", b"X-ICE-SSB-Profile"}
 
-                if "Categories=" in line:
-                    self.category = line.replace("Categories=", "").replace("GTK;", "").replace(";", "")
-                    continue
+# Parses a .desktop file, returns a WebAppLauncher or None if the file isn't a webapp
+def read_launcher(path):
+    with open(path, 'rb') as desktop_file:
+        data = desktop_file.read()
+
+    # Reject regular launchers without decoding them
+    if WEBAPP_MARKER.search(data) == None:
+        return None
+
+    # Only the [Desktop Entry] group is relevant (actions and other groups are ignored)
+    group = DESKTOP_ENTRY_GROUP.search(data)
+    if group == None or WEBAPP_MARKER.search(group.group(1)) == None:
+        return None
+
+    values = {}
+    for line in group.group(1).splitlines():
+        key, separator, value = line.partition(b"=")
+        key = key.strip()
+        if separator and key in LAUNCHER_KEYS:
+            values[key] = value.strip().decode("UTF-8", "replace")
+
+    name = values.get(b"Name")
+    icon = values.get(b"Icon")
+    if name == None or icon == None:
+        return None
+
+    exec_line = values.get(b"Exec")
+    category = values.get(b"Categories")
+    if category != None:
+        category = category.replace("GTK;", "").replace(";", "")
+    if b"IceFirefox" in values:
+        browser_type = BROWSER_TYPE_FIREFOX
+        profile = values[b"IceFirefox"]
+    elif b"IceEpiphany" in values:
+        browser_type = BROWSER_TYPE_EPIPHANY
+        profile = values[b"IceEpiphany"]
+    else:
+        browser_type = BROWSER_TYPE_CHROMIUM
+        profile = values.get(b"X-ICE-SSB-Profile")
+    url = get_launch_url(exec_line) if exec_line != None else None
+
+    return WebAppLauncher(path, (name, icon, exec_line, category, profile, url, browser_type))
+
+# Splits an Exec line into a tuple of arguments, as described in the desktop entry specification.
+# The result is cached, since it only depends on the launcher (it's a tuple, so callers can't modify the cached value).
+# Reserved characters (&, ?, #...) are accepted outside of quotes, since webapp URLs
+# are written unquoted and there's no shell to interpret them.
+# Raises ValueError if a quote isn't terminated.
+@functools.lru_cache(maxsize=256)
+def parse_exec(exec_line, name=None, icon=None, path=None):
+    # Escape sequences of string values (\s, \n...) come first
+    exec_line = re.sub(r"\\(.)", lambda match: EXEC_STRING_ESCAPES.get(match.group(1), match.group(0)), exec_line)
+    arguments = []
+    argument = None # None between arguments
+    quoted = False
+    i = 0
+    while i < len(exec_line):
+        char = exec_line[i]
+        if quoted:
+            if char == '"':
+                quoted = False
+            elif char == "\\" and i + 1 < len(exec_line) and exec_line[i + 1] in EXEC_QUOTED_ESCAPES:
+                i += 1
+                argument += exec_line[i]
+            elif char == "%" and exec_line[i + 1:i + 2] == "%":
+                # Percent signs are escaped inside quotes too (GLib expands them before the quotes)
+                i += 1
+                argument += "%"
+            else:
+                argument += char
+        elif char in " \t\n":
+            if argument != None:
+                arguments.append(argument)
+                argument = None
+        elif char == '"':
+            quoted = True
+            argument = argument or ""
+        elif char == "%" and i + 1 < len(exec_line):
+            i += 1
+            code = exec_line[i]
+            if code == "%":
+                argument = (argument or "") + "%"
+            elif code == "i" and argument == None:
+                # --icon <icon> (only when the key is set), as two arguments
+                if icon:
+                    arguments.extend(["--icon", icon])
+            elif code == "c":
+                argument = (argument or "") + (name or "")
+            elif code == "k":
+                argument = (argument or "") + (path or "")
+            # Files and URLs (%f %F %u %U) are never passed, deprecated codes are removed
+        else:
+            argument = (argument or "") + char
+        i += 1
+    if quoted:
+        raise ValueError("Unterminated quote in %s" % exec_line)
+    if argument != None:
+        arguments.append(argument)
+    return tuple(arguments)
+
+EXEC_STRING_ESCAPES = {"s": " ", "n": "\n", "t": "\t", "r": "\r", "\\": "\\", ";": ";"}
+EXEC_QUOTED_ESCAPES = '"`$\\'
+EXEC_RESERVED_CHARS = ' \t\n"\'\\><~|&;$*?#()`'
+
+# Quotes an argument of an Exec line when it contains reserved characters
+# (paths picked by the user can contain spaces...), the reverse of parse_exec()
+def quote_exec_argument(argument):
+    argument = argument.replace("%", "%%")
+    if argument != "" and not any(char in EXEC_RESERVED_CHARS for char in argument):
+        return argument
+    argument = "".join("\\" + char if char in EXEC_QUOTED_ESCAPES else char for char in argument)
+    # The Exec key is also a string value, where backslashes are escaped once more
+    return '"%s"' % argument.replace("\\", "\\\\").replace("\n", "\\n")
+
+# Returns the URL a webapp opens, given its Exec line
+def get_launch_url(exec_line):
+    match = re.search(r'--app=(\S+)', exec_line)
+    if match == None:
+        # Firefox and Epiphany take the URL as their last argument
+        matches = re.findall(r'[a-zA-Z][a-zA-Z0-9+.-]*://[^\s"]+', exec_line)
+        return matches[-1] if len(matches) > 0 else None
+    return match.group(1)
+
+# Replaces the URL a webapp opens in its Exec line (see get_launch_url()).
+# Raises ValueError if the Exec line doesn't contain a URL.
+def set_launch_url(exec_line, url):
+    match = re.search(r'--app=(\S+)', exec_line)
+    if match != None:
+        return exec_line[:match.start(1)] + url + exec_line[match.end(1):]
+    old_url = get_launch_url(exec_line)
+    if old_url == None:
+        raise ValueError("No URL in %s" % exec_line)
+    start = exec_line.rindex(old_url)
+    return exec_line[:start] + url + exec_line[start + len(old_url):]
+
+# Returns the arguments which move the disk cache of a Chromium webapp out of its profile
+# (an empty string when cache_directory is None), cache_size is in MB
+def get_chromium_cache_args(cache_directory, cache_size):
+    if cache_directory == None:
+        return ""
+    return " %s --disk-cache-size=%d" % (quote_exec_argument("--disk-cache-dir=" + cache_directory), cache_size * 1024 * 1024)
+
+# Quoted --disk-cache-dir argument, as written by quote_exec_argument() (backslashes are escaped twice)
+CHROMIUM_CACHE_ARGS = re.compile(r'[ \t]+(?:"--disk-cache-dir=(?:\\\\\\\\|\\\\["`$]|\\[^\\]|[^"\\])*"|--disk-cache-(?:dir|size)=\S+)')
+
+# Replaces the disk cache arguments of the Exec line of a Chromium webapp
+def set_chromium_cache_args(exec_line, cache_directory, cache_size):
+    return CHROMIUM_CACHE_ARGS.sub("", exec_line) + get_chromium_cache_args(cache_directory, cache_size)
+
+# On-disk index of the launchers found in APPS_DIR.
+# Each file is identified by its (inode, mtime, size), so only new
+# or modified files need to be parsed again.
+class LauncherIndex():
+
+    VERSION = 2
+
+    def __init__(self, path=LAUNCHER_INDEX):
+        self.path = path
+        self.entries = {} # filename -> [inode, mtime, size, fields or None]
+        self.launchers = {} # filename -> WebAppLauncher (valid webapps only)
+        self.dirty = False # entries were updated by update() since the index was saved
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as index_file:
+                data = json.load(index_file)
+            if data.get("version") == self.VERSION:
+                self.entries = data["entries"]
+        except Exception:
+            # Missing or corrupted index, it gets rebuilt by the next scan
+            self.entries = {}
+
+    def save(self):
+        self.dirty = False
+        self.write(self.get_data())
+
+    # Entries are replaced rather than modified in place, so a shallow copy is a consistent snapshot
+    def get_data(self):
+        return {"version": self.VERSION, "entries": dict(self.entries)}
+
+    def write(self, data):
+        with self.lock:
+            tmp_path = "%s.%d.tmp" % (self.path, threading.get_ident())
+            try:
+                with open(tmp_path, 'w') as index_file:
+                    json.dump(data, index_file, separators=(",", ":"))
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(e)
 
-                if "IceFirefox=" in line:
-                    self.profile = line.replace('IceFirefox=', '')
-                    self.is_firefox = True
+    # Saves the entries updated by scan() or update() in the background, if there are any.
+    # An index which wasn't saved is harmless, the next scan parses these files again.
+    # save() is only used when the application exits.
+    def flush(self):
+        if self.dirty:
+            self.dirty = False
+            get_task_executor().submit(self.write, self.get_data())
 
-                elif "X-ICE-SSB-Profile=" in line:
-                    self.profile = line.replace('X-ICE-SSB-Profile=', '')
-                    self.is_isolated = True
+    # Brings the entry of a single file up to date, returns its launcher (or None if it's not a webapp).
+    # The index isn't written, see flush().
+    def update(self, directory, filename):
+        launcher, changed = self._update(directory, filename, self.entries)
+        if changed:
+            self.dirty = True
+        return launcher
 
-        if self.is_webapp and self.name != None and self.icon != None:
-            self.is_valid = True
+    def _update(self, directory, filename, entries):
+        # Only .desktop files are launchers (temporary files are ignored)
+        if not filename.endswith(".desktop"):
+            return (None, False)
+        path = os.path.join(directory, filename)
+        try:
+            info = os.stat(path)
+        except OSError:
+            # The file was removed (or it's a broken symlink)
+            changed = entries.pop(filename, None) != None
+            self.launchers.pop(filename, None)
+            return (None, changed)
+        if stat.S_ISDIR(info.st_mode):
+            return (None, False)
+        key = [info.st_ino, info.st_mtime_ns, info.st_size]
+        entry = self.entries.get(filename)
+        if entry != None and entry[:3] == key:
+            entries[filename] = entry
+            launcher = self.launchers.get(filename)
+            if launcher == None and entry[3] != None:
+                launcher = WebAppLauncher(path, entry[3])
+                self.launchers[filename] = launcher
+            return (launcher, False)
+        try:
+            with tracer.span("parse launcher", "launchers", file=filename):
+                launcher = read_launcher(path)
+        except OSError as e:
+            # Unreadable file
+            print(e)
+            launcher = None
+        if launcher != None:
+            entries[filename] = key + [launcher.get_fields()]
+            self.launchers[filename] = launcher
+        else:
+            entries[filename] = key + [None]
+            self.launchers.pop(filename, None)
+            launcher = None
+        return (launcher, True)
+
+    # Refreshes the whole index, costs one stat() per file for unchanged launchers
+    def scan(self, directory):
+        with tracer.span("scan launchers", "launchers", directory=directory) as span:
+            entries = {}
+            changed = False
+            launchers = []
+            for filename in os.listdir(directory):
+                launcher, modified = self._update(directory, filename, entries)
+                changed = changed or modified
+                if launcher != None:
+                    launchers.append(launcher)
+            if changed or len(entries) != len(self.entries):
+                for filename in self.entries.keys() - entries.keys():
+                    self.launchers.pop(filename, None)
+                self.entries = entries
+                self.dirty = True
+            # The scan runs in the main loop, the index is written in the background
+            self.flush()
+            span.set("files", len(entries))
+            span.set("webapps", len(launchers))
+        return launchers
+
+# Size-bounded on-disk cache of binary blobs.
+# The mtime of each file is used as its last access time,
+# the least recently used entries are evicted first.
+class FileCache():
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None # computed on the first write
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("UTF-8")).hexdigest())
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                data = cache_file.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        path = self.get_path(key)
+        tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(e)
+            return
+        with self.lock:
+            if self.size == None:
+                self.size = self.get_usage()[0]
+            else:
+                self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def get_usage(self):
+        size = 0
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                info = entry.stat()
+            except OSError:
+                continue
+            size += info.st_size
+            entries.append((info.st_mtime, info.st_size, entry.path))
+        return (size, entries)
+
+    def evict(self):
+        self.size, entries = self.get_usage()
+        for mtime, size, path in sorted(entries):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+def reflink_file(source, destination):
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copymode(source, destination)
+
+# Copies a file, sharing its data with the source whenever possible:
+# - as a reflink (copy-on-write clone), if the filesystem supports it
+# - as a hardlink, if the file is read-only (so it can't be modified through the link)
+# - as a regular copy otherwise
+# Returns the strategy which was used.
+def clone_file(source, destination, strategies=(CLONE_REFLINK, CLONE_HARDLINK, CLONE_COPY)):
+    if CLONE_REFLINK in strategies:
+        try:
+            reflink_file(source, destination)
+            return CLONE_REFLINK
+        except OSError:
+            if os.path.exists(destination):
+                os.remove(destination)
+    if CLONE_HARDLINK in strategies and not os.access(source, os.W_OK):
+        try:
+            os.link(source, destination)
+            return CLONE_HARDLINK
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+    return CLONE_COPY
+
+# Recursive version of clone_file(), returns the number of files cloned with each strategy
+def clone_tree(source, destination, strategies=(CLONE_REFLINK, CLONE_HARDLINK, CLONE_COPY)):
+    counts = [0, 0, 0]
+    os.makedirs(destination)
+    for entry in os.scandir(source):
+        target = os.path.join(destination, entry.name)
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), target)
+        elif entry.is_dir():
+            for strategy, count in enumerate(clone_tree(entry.path, target, strategies)):
+                counts[strategy] += count
+        else:
+            counts[clone_file(entry.path, target, strategies)] += 1
+    shutil.copystat(source, destination)
+    return counts
+
+# Incremental disk usage of directory trees.
+# Each directory is cached with its mtime, the size of its files and its subdirectories,
+# so only directories whose entries were added, removed or renamed since the last
+# computation are listed again. Browsers mostly create and delete files in their caches,
+# so the result is a close estimate which costs one stat() per directory.
+class DiskUsageIndex():
+
+    def __init__(self, path=DISK_USAGE_INDEX):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as index_file:
+                self.entries = json.load(index_file) # directory -> [mtime, size of its files, subdirectories]
+        except Exception:
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            tmp_path = "%s.%d.tmp" % (self.path, threading.get_ident())
+            try:
+                with open(tmp_path, 'w') as index_file:
+                    json.dump(self.entries, index_file, separators=(",", ":"))
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(e)
+
+    def get_size(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            with self.lock:
+                self.entries.pop(directory, None)
+            return 0
+        with self.lock:
+            entry = self.entries.get(directory)
+        if entry == None or entry[0] != mtime:
+            size = 0
+            subdirs = []
+            try:
+                for item in os.scandir(directory):
+                    try:
+                        if item.is_dir(follow_symlinks=False):
+                            subdirs.append(item.name)
+                        else:
+                            size += item.stat(follow_symlinks=False).st_blocks * 512
+                    except OSError:
+                        pass
+            except OSError:
+                pass
+            entry = [mtime, size, subdirs]
+            with self.lock:
+                self.entries[directory] = entry
+        return entry[1] + sum(self.get_size(os.path.join(directory, subdir)) for subdir in entry[2])
+
+# Returns the size of a directory tree, without any cache
+def get_tree_size(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_blocks * 512
+            except OSError:
+                pass
+    return size
+
+# Returns whether a process uses the given profile directory (in its command line)
+def is_profile_in_use(profile_path):
+    profile_path = profile_path.encode("UTF-8")
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/cmdline" % pid, 'rb') as cmdline_file:
+                if profile_path in cmdline_file.read():
+                    return True
+        except OSError:
+            pass
+    return False
+
+# Sets preferences in the user.js file of a Firefox profile, a None value removes the preference
+def set_firefox_prefs(profile_path, prefs):
+    path = os.path.join(profile_path, "user.js")
+    with open(path) as prefs_file:
+        lines = prefs_file.read().splitlines()
+    # Previous values of the preferences are removed, rather than overridden
+    patterns = [re.compile(r'^user_pref\(%s,' % re.escape(json.dumps(key))) for key, value in prefs]
+    lines = [line for line in lines if not any(pattern.match(line) for pattern in patterns)]
+    for key, value in prefs:
+        if value != None:
+            lines.append("user_pref(%s, %s);" % (json.dumps(key), json.dumps(value)))
+    # user.js might be a link to the profile template, replace it rather than writing through it
+    os.remove(path)
+    with open(path, 'w') as prefs_file:
+        prefs_file.write("\n".join(lines) + "\n")
+
+# Returns the preferences which move the disk cache of a Firefox webapp out of its profile, cache_size is in MB.
+# When cache_directory is None, the values of the profile template are restored.
+def get_firefox_cache_prefs(cache_directory, cache_size):
+    if cache_directory != None:
+        return [("browser.cache.disk.enable", True),
+                ("browser.cache.disk.parent_directory", cache_directory),
+                ("browser.cache.disk.capacity", cache_size * 1024)]
+    with open(os.path.join(FIREFOX_PROFILE_TEMPLATE, "user.js")) as prefs_file:
+        content = prefs_file.read()
+    return [("browser.cache.disk.enable", get_firefox_pref(content, "browser.cache.disk.enable")),
+            ("browser.cache.disk.parent_directory", None),
+            ("browser.cache.disk.capacity", get_firefox_pref(content, "browser.cache.disk.capacity"))]
+
+# Returns the value of a preference in the content of a user.js file (or None).
+# Firefox applies the last value when a preference is set several times.
+def get_firefox_pref(content, key):
+    values = re.findall(r'^user_pref\(%s,\s*(.*)\);' % re.escape(json.dumps(key)), content, re.MULTILINE)
+    if len(values) == 0:
+        return None
+    return json.loads(values[-1])
+
+# Writes a file atomically: the content goes to a temporary file in the same directory,
+# which replaces the file once complete (so file watchers never see partial launchers)
+def write_file_atomically(path, content):
+    tmp_path = os.path.join(os.path.dirname(path), ".%s.%d.tmp" % (os.path.basename(path), threading.get_ident()))
+    try:
+        with open(tmp_path, 'w') as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Sets keys of the [Desktop Entry] group of a launcher.
+# The content is edited line by line, so comments, other keys and groups are kept as they are.
+def set_desktop_entry_keys(content, values):
+    lines = content.splitlines()
+    values = dict(values)
+    group = None
+    end = None # index after the last line of the [Desktop Entry] group
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith("["):
+            group = stripped
+            continue
+        if group != "[Desktop Entry]":
+            continue
+        key, separator, value = line.partition("=")
+        key = key.strip()
+        if separator and key in values:
+            lines[i] = "%s=%s" % (key, values.pop(key))
+        if stripped != "":
+            end = i + 1
+    if end == None:
+        # No [Desktop Entry] group (or an empty one)
+        if "[Desktop Entry]" not in [line.strip() for line in lines]:
+            lines.insert(0, "[Desktop Entry]")
+        end = [line.strip() for line in lines].index("[Desktop Entry]") + 1
+    lines[end:end] = ["%s=%s" % (key, value) for key, value in values.items()]
+    return "\n".join(lines) + "\n"
+
+# Tells the desktop menus to reload the launchers (when update-desktop-database is installed)
+def update_desktop_database():
+    if shutil.which("update-desktop-database") != None:
+        try:
+            subprocess.run(["update-desktop-database", "-q", APPS_DIR], timeout=30)
+        except Exception as e:
+            print(e)
+
+# Files of each profile which the browser used during its last launches.
+# They're learned from the files the browser keeps open and the ones it modified,
+# and read ahead into the page cache before the next launch.
+class PrewarmIndex():
+
+    def __init__(self, path=PREWARM_INDEX):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as index_file:
+                self.entries = json.load(index_file) # profile path -> relative paths of its hot files
+        except Exception:
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            tmp_path = "%s.%d.tmp" % (self.path, threading.get_ident())
+            try:
+                with open(tmp_path, 'w') as index_file:
+                    json.dump(self.entries, index_file, separators=(",", ":"))
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(e)
+
+    def get_hot_files(self, profile_path, browser_type):
+        with self.lock:
+            files = self.entries.get(profile_path)
+        if files != None:
+            return files
+        return FIREFOX_HOT_FILES if browser_type == BROWSER_TYPE_FIREFOX else CHROMIUM_HOT_FILES
+
+    def set_hot_files(self, profile_path, files):
+        with self.lock:
+            self.entries[profile_path] = sorted(files)[:PREWARM_MAX_FILES]
+
+    # Returns True if the profile was in the index
+    def remove(self, profile_path):
+        with self.lock:
+            return self.entries.pop(profile_path, None) != None
+
+# Asks the kernel to read files into the page cache, without waiting for it.
+# Returns the number of files and bytes requested.
+def prewarm_files(directory, relative_paths, max_size=PREWARM_MAX_SIZE):
+    num_files = 0
+    size = 0
+    for relative_path in relative_paths:
+        try:
+            fd = os.open(os.path.join(directory, relative_path), os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            continue
+        try:
+            length = os.fstat(fd).st_size
+            if size + length > max_size:
+                continue
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            num_files += 1
+            size += length
+        except OSError as e:
+            print(e)
+        finally:
+            os.close(fd)
+    return (num_files, size)
+
+# Returns the files of a profile which are open in the processes using it (relative paths)
+def get_open_profile_files(profile_path):
+    files = set()
+    prefix = profile_path.rstrip("/") + "/"
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/cmdline" % pid, 'rb') as cmdline_file:
+                if profile_path.encode("UTF-8") not in cmdline_file.read():
+                    continue
+            for fd in os.listdir("/proc/%s/fd" % pid):
+                target = os.readlink("/proc/%s/fd/%s" % (pid, fd))
+                if target.startswith(prefix):
+                    files.add(target[len(prefix):])
+        except OSError:
+            pass
+    return files
+
+# Returns the files of a profile modified since a given time (caches excluded, relative paths)
+def get_modified_profile_files(profile_path, since):
+    files = set()
+    for root, dirs, filenames in os.walk(profile_path):
+        dirs[:] = [name for name in dirs if name not in PROFILE_CACHE_DIRS]
+        for name in filenames:
+            path = os.path.join(root, name)
+            try:
+                info = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(info.st_mode) and info.st_mtime >= since:
+                files.add(os.path.relpath(path, profile_path))
+    return files
 
 # This is the backend.
 # It contains utility functions to load,
@@ -98,19 +997,56 @@ class WebAppLauncher():
 class WebAppManager():
 
     def __init__(self):
-        for directory in [ICE_DIR, APPS_DIR, PROFILES_DIR, FIREFOX_PROFILES_DIR, ICONS_DIR, EPIPHANY_PROFILES_DIR]:
+        for directory in [ICE_DIR, APPS_DIR, PROFILES_DIR, FIREFOX_PROFILES_DIR, ICONS_DIR, EPIPHANY_PROFILES_DIR, TRASH_DIR]:
             if not os.path.exists(directory):
                 os.makedirs(directory)
+        self.index = LauncherIndex()
+        self.disk_usage = DiskUsageIndex()
+        self.prewarm_index = PrewarmIndex()
+        self.shared_cache_directory = SHARED_CACHE_DIR
+        self.trash_lock = threading.Lock()
+        # Menu refreshes are coalesced within a batch (see batch())
+        self.batch_lock = threading.Lock()
+        self.batch_depth = 0
+        self.launchers_modified = False
+        # Finish deleting the profiles which were left in the trash by a previous run
+        if len(os.listdir(TRASH_DIR)) > 0:
+            self.empty_trash()
 
     def get_webapps(self):
-        webapps = []
-        for filename in os.listdir(APPS_DIR):
-            path = os.path.join(APPS_DIR, filename)
-            if not os.path.isdir(path):
-                webapp = WebAppLauncher(path)
-                if webapp.is_valid:
-                    webapps.append(webapp)
-        return (webapps)
+        return self.index.scan(APPS_DIR)
+
+    # Groups launcher changes, the desktop menus are only refreshed once, at the end of the batch
+    @contextlib.contextmanager
+    def batch(self):
+        with self.batch_lock:
+            self.batch_depth += 1
+        try:
+            yield
+        finally:
+            with self.batch_lock:
+                self.batch_depth -= 1
+                refresh = self.batch_depth == 0 and self.launchers_modified
+                if refresh:
+                    self.launchers_modified = False
+            if refresh:
+                update_desktop_database()
+
+    # Called after a launcher is written or removed
+    def on_launchers_modified(self):
+        with self.batch_lock:
+            if self.batch_depth > 0:
+                self.launchers_modified = True
+                return
+        self.refresh_menus()
+
+    @_async
+    def refresh_menus(self):
+        update_desktop_database()
+
+    # Returns the launcher of a single .desktop file (or None if it's not a webapp anymore)
+    def get_webapp(self, path):
+        return self.index.update(os.path.dirname(path), os.path.basename(path))
 
     def get_supported_browsers(self):
         browsers = []
@@ -125,95 +1061,337 @@ class WebAppManager():
         browsers.append(Browser(BROWSER_TYPE_CHROMIUM, "Vivaldi", "vivaldi", "/usr/bin/vivaldi-stable"))
         return browsers
 
+    # Returns the isolated profile directories of a webapp
+    def get_profile_paths(self, webapp):
+        if webapp.profile == None:
+            return []
+        if webapp.browser_type == BROWSER_TYPE_FIREFOX:
+            path = os.path.join(FIREFOX_PROFILES_DIR, webapp.profile)
+        elif webapp.browser_type == BROWSER_TYPE_EPIPHANY:
+            path = os.path.join(EPIPHANY_PROFILES_DIR, "epiphany-%s" % webapp.profile)
+        else:
+            path = os.path.join(PROFILES_DIR, webapp.profile)
+        return [path] if os.path.isdir(path) else []
+
+    # Returns the disk usage of the profile of a webapp (or None if it doesn't have its own profile)
+    def get_disk_usage(self, webapp):
+        paths = self.get_profile_paths(webapp)
+        if len(paths) == 0:
+            return None
+        return sum(self.disk_usage.get_size(path) for path in paths)
+
+    # Removes the caches of a webapp profile, returns the number of bytes reclaimed
+    # or None if the browser is using the profile
+    def compact_webapp(self, webapp):
+        reclaimed = 0
+        for profile_path in self.get_profile_paths(webapp):
+            if is_profile_in_use(profile_path):
+                return None
+            for directory in [profile_path] + [entry.path for entry in os.scandir(profile_path) if entry.is_dir(follow_symlinks=False)]:
+                for name in PROFILE_CACHE_DIRS:
+                    path = os.path.join(directory, name)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        reclaimed += get_tree_size(path)
+                        self.move_to_trash(path)
+        self.empty_trash()
+        return reclaimed
+
+    # Reads the hot files of the profile of a webapp into the page cache (before launching it)
+    @_async
+    def prewarm_webapp(self, webapp):
+        for profile_path in self.get_profile_paths(webapp):
+            with tracer.span("prewarm profile", "profiles", path=profile_path) as span:
+                (num_files, size) = prewarm_files(profile_path, self.prewarm_index.get_hot_files(profile_path, webapp.browser_type))
+                span.set("files", num_files)
+                span.set("bytes", size)
+
+    # Learns the hot files of the profile of a running webapp, launched at launch_time
+    @_async
+    def learn_hot_files(self, webapp, launch_time):
+        for profile_path in self.get_profile_paths(webapp):
+            files = get_open_profile_files(profile_path) | get_modified_profile_files(profile_path, launch_time)
+            if len(files) > 0:
+                self.prewarm_index.set_hot_files(profile_path, files)
+        self.prewarm_index.save()
+
+    # Returns the directory of the browser disk cache of a webapp, or None if it's in its profile
+    def get_cache_directory(self, codename, cache_location):
+        if cache_location == CACHE_LOCATION_RUNTIME:
+            runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or "/run/user/%d" % os.getuid()
+            return os.path.join(runtime_dir, "webapp-manager", codename)
+        if cache_location == CACHE_LOCATION_SHARED:
+            return os.path.join(self.shared_cache_directory, codename)
+        return None
+
+    # Returns the disk cache settings of a webapp, as (cache location, directory, size in MB).
+    # The directory and the size are None when the cache is in the profile.
+    # They're read from the webapp (Exec line or Firefox prefs), so they're found even if
+    # the cache settings of the application changed since the webapp was created.
+    def get_webapp_cache_settings(self, webapp):
+        cache_directory = None
+        cache_size = None
+        if webapp.profile == None:
+            return (CACHE_LOCATION_PROFILE, None, None)
+        try:
+            if webapp.browser_type == BROWSER_TYPE_FIREFOX:
+                for profile_path in self.get_profile_paths(webapp):
+                    with open(os.path.join(profile_path, "user.js")) as prefs_file:
+                        content = prefs_file.read()
+                    cache_directory = get_firefox_pref(content, "browser.cache.disk.parent_directory")
+                    capacity = get_firefox_pref(content, "browser.cache.disk.capacity") # KB
+                    if capacity != None:
+                        cache_size = int(capacity) // 1024
+            elif webapp.browser_type == BROWSER_TYPE_CHROMIUM:
+                for argument in webapp.get_argv():
+                    if argument.startswith("--disk-cache-dir="):
+                        cache_directory = argument[len("--disk-cache-dir="):]
+                    elif argument.startswith("--disk-cache-size="):
+                        cache_size = int(argument[len("--disk-cache-size="):]) // (1024 * 1024)
+        except (OSError, ValueError) as e:
+            print(e)
+        # Only directories created for the webapp are considered (see create_webapp()),
+        # so a hand-edited launcher can't point the deletion at another directory
+        if cache_directory == None or os.path.basename(os.path.normpath(cache_directory)) != webapp.profile:
+            return (CACHE_LOCATION_PROFILE, None, None)
+        if os.path.normpath(cache_directory) == self.get_cache_directory(webapp.profile, CACHE_LOCATION_RUNTIME):
+            return (CACHE_LOCATION_RUNTIME, cache_directory, cache_size)
+        return (CACHE_LOCATION_SHARED, cache_directory, cache_size)
+
+    # Returns whether the Firefox profile of a webapp shows the navigation bar
+    def has_navbar(self, webapp):
+        for profile_path in self.get_profile_paths(webapp):
+            try:
+                return filecmp.cmp(os.path.join(profile_path, "chrome", "userChrome.css"), FIREFOX_NAVBAR_CSS, shallow=False)
+            except OSError as e:
+                print(e)
+        return False
+
+    # Profiles are moved to the trash (an atomic rename), and deleted in the background
     def delete_webbapp(self, webapp):
+        if any([self.prewarm_index.remove(profile_path) for profile_path in self.get_profile_paths(webapp)]):
+            self.prewarm_index.save()
         if webapp.profile != None:
-            shutil.rmtree(os.path.join(FIREFOX_PROFILES_DIR, webapp.profile), ignore_errors=True)
-            shutil.rmtree(os.path.join(EPIPHANY_PROFILES_DIR, "/epiphany-%s" % webapp.profile), ignore_errors=True)
-            shutil.rmtree(os.path.join(PROFILES_DIR, webapp.profile), ignore_errors=True)
-        if os.path.exists(webapp.path):
+            # Firefox keeps the location of its cache in its profile, it's read before the profile is removed
+            cache_directory = self.get_webapp_cache_settings(webapp)[1]
+            self.move_to_trash(os.path.join(FIREFOX_PROFILES_DIR, webapp.profile))
+            self.move_to_trash(os.path.join(EPIPHANY_PROFILES_DIR, "epiphany-%s" % webapp.profile))
+            self.move_to_trash(os.path.join(PROFILES_DIR, webapp.profile))
+            if cache_directory != None:
+                self.move_to_trash(cache_directory)
+        # Epiphany launchers are symlinks to a file in their profile
+        if os.path.lexists(webapp.path):
             os.remove(webapp.path)
+            self.on_launchers_modified()
+        self.empty_trash()
+
+    def move_to_trash(self, path):
+        if not os.path.exists(path):
+            return
+        # Caches in memory or on network storage can't be renamed into the trash, they're deleted where they are
+        if os.stat(path).st_dev != os.stat(TRASH_DIR).st_dev:
+            self.delete_directory(path)
+            return
+        random_code = ''.join(choice(string.digits) for _ in range(8))
+        with tracer.span("trash profile", "profiles", path=path):
+            try:
+                os.rename(path, os.path.join(TRASH_DIR, "%s-%s" % (os.path.basename(path), random_code)))
+            except OSError as e:
+                print(e)
+                self.delete_directory(path)
+
+    @_async
+    def delete_directory(self, path):
+        with tracer.span("delete directory", "profiles", path=path):
+            shutil.rmtree(path, ignore_errors=True)
 
-    def create_webapp(self, name, url, icon, category, browser, isolate_profile=True, navbar=False):
+    @_async
+    def empty_trash(self):
+        with self.trash_lock, tracer.span("delete profiles", "profiles") as span:
+            filenames = os.listdir(TRASH_DIR)
+            for filename in filenames:
+                path = os.path.join(TRASH_DIR, filename)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            span.set("entries", len(filenames))
+
+    def create_webapp(self, name, url, icon, category, browser, isolate_profile=True, navbar=False,
+                      cache_location=CACHE_LOCATION_PROFILE, cache_size=CACHE_SIZE):
         # Generate a 4 digit random code (to prevent name collisions, so we can define multiple launchers with the same name)
         random_code =  ''.join(choice(string.digits) for _ in range(4))
         codename = "".join(filter(str.isalpha, name)) + random_code
         path = os.path.join(APPS_DIR, "webapp-%s.desktop" % codename)
+        # Where the browser keeps its disk cache (None: in the profile)
+        cache_directory = self.get_cache_directory(codename, cache_location)
+
+        # The launcher is built in memory and written in one go, once the profile is ready
+        lines = []
+        lines.append("[Desktop Entry]")
+        lines.append("Version=1.0")
+        lines.append("Name=%s" % name)
+        lines.append("Comment=%s (Web App)" % name)
 
-        with open(path, 'w') as desktop_file:
-            desktop_file.write("[Desktop Entry]\n")
-            desktop_file.write("Version=1.0\n")
-            desktop_file.write("Name=%s\n" % name)
-            desktop_file.write("Comment=%s (Web App)\n" % name)
-
-            if browser.browser_type == BROWSER_TYPE_FIREFOX:
-                # Firefox based
-                firefox_profile_path = os.path.join(FIREFOX_PROFILES_DIR, codename)
-                desktop_file.write("Exec=" + browser.exec_path +
-                                    " --class ICE-SSB-" + codename +
-                                    " --profile " + firefox_profile_path +
-                                    " --no-remote " + url + "\n")
-                desktop_file.write("IceFirefox=%s\n" % codename)
-                # Create a Firefox profile
-                shutil.copytree('/usr/share/webapp-manager/firefox/profile', firefox_profile_path)
-                if navbar:
-                    shutil.copy('/usr/share/webapp-manager/firefox/userChrome-with-navbar.css', os.path.join(firefox_profile_path, "chrome", "userChrome.css"))
-            elif browser.browser_type == BROWSER_TYPE_EPIPHANY:
-                # Epiphany based
-                epiphany_profile_path = os.path.join(EPIPHANY_PROFILES_DIR, "epiphany-" + codename)
-                desktop_file.write("Exec=" + browser.exec_path +
-                                    " --application-mode " +
-                                    " --profile=\"" + epiphany_profile_path + "\"" +
-                                    "" + url + "\n")
-                desktop_file.write("IceEpiphany=%s\n" %codename)
+        if browser.browser_type == BROWSER_TYPE_FIREFOX:
+            # Firefox based
+            firefox_profile_path = os.path.join(FIREFOX_PROFILES_DIR, codename)
+            lines.append("Exec=" + browser.exec_path +
+                         " --class ICE-SSB-" + codename +
+                         " --profile " + firefox_profile_path +
+                         " --no-remote " + url)
+            lines.append("IceFirefox=%s" % codename)
+            # Create a Firefox profile
+            with tracer.span("copy profile", "profiles", path=firefox_profile_path) as span:
+                counts = clone_tree(FIREFOX_PROFILE_TEMPLATE, firefox_profile_path)
+                span.set("reflinked", counts[CLONE_REFLINK])
+                span.set("hardlinked", counts[CLONE_HARDLINK])
+                span.set("copied", counts[CLONE_COPY])
+            if navbar:
+                user_chrome_path = os.path.join(firefox_profile_path, "chrome", "userChrome.css")
+                os.remove(user_chrome_path)
+                clone_file(FIREFOX_NAVBAR_CSS, user_chrome_path)
+            if cache_directory != None:
+                set_firefox_prefs(firefox_profile_path, get_firefox_cache_prefs(cache_directory, cache_size))
+        elif browser.browser_type == BROWSER_TYPE_EPIPHANY:
+            # Epiphany based
+            epiphany_profile_path = os.path.join(EPIPHANY_PROFILES_DIR, "epiphany-" + codename)
+            lines.append("Exec=" + browser.exec_path +
+                         " --application-mode" +
+                         " --profile=\"" + epiphany_profile_path + "\" " +
+                         url)
+            lines.append("IceEpiphany=%s" % codename)
+        else:
+            # Chromium based
+            if isolate_profile:
+                profile_path = os.path.join(PROFILES_DIR, codename)
+                lines.append("Exec=" + browser.exec_path +
+                             " --app=" + url +
+                             " --class=ICE-SSB-" + codename +
+                             " --user-data-dir=" + profile_path +
+                             get_chromium_cache_args(cache_directory, cache_size))
+                lines.append("X-ICE-SSB-Profile=%s" % codename)
             else:
-                # Chromium based
-                if isolate_profile:
-                    profile_path = os.path.join(PROFILES_DIR, codename)
-                    desktop_file.write("Exec=" + browser.exec_path +
-                                        " --app=" + url +
-                                        " --class=ICE-SSB-" + codename +
-                                        " --user-data-dir=" + profile_path + "\n")
-                    desktop_file.write("X-ICE-SSB-Profile=%s\n" % codename)
-                else:
-                    desktop_file.write("Exec=" + browser.exec_path +
-                                        " --app=" + url +
-                                        " --class=ICE-SSB-" + codename + "\n")
-
-            desktop_file.write("Terminal=false\n")
-            desktop_file.write("X-MultipleArgs=false\n")
-            desktop_file.write("Type=Application\n")
-            desktop_file.write("Icon=%s\n" % icon)
-            desktop_file.write("Categories=GTK;%s;\n" % category)
-            desktop_file.write("MimeType=text/html;text/xml;application/xhtml_xml;\n")
-            desktop_file.write("StartupWMClass=ICE-SSB-%s\n" % codename)
-            desktop_file.write("StartupNotify=true\n")
-
-            if browser.browser_type == BROWSER_TYPE_EPIPHANY:
-                # Move the desktop file and create a symlink
-                new_path = os.path.join(profile_path, "epiphany-%s.desktop" % codename)
-                os.makedirs(profile_path)
-                os.replace(path, new_path)
-                os.symlink(new_path, path)
+                lines.append("Exec=" + browser.exec_path +
+                             " --app=" + url +
+                             " --class=ICE-SSB-" + codename)
+
+        lines.append("Terminal=false")
+        lines.append("X-MultipleArgs=false")
+        lines.append("Type=Application")
+        lines.append("Icon=%s" % icon)
+        lines.append("Categories=GTK;%s;" % category)
+        lines.append("MimeType=text/html;text/xml;application/xhtml_xml;")
+        lines.append("StartupWMClass=ICE-SSB-%s" % codename)
+        lines.append("StartupNotify=true")
+        content = "\n".join(lines) + "\n"
+
+        if browser.browser_type == BROWSER_TYPE_EPIPHANY:
+            # The desktop file lives in the profile, with a symlink in APPS_DIR
+            new_path = os.path.join(epiphany_profile_path, "epiphany-%s.desktop" % codename)
+            os.makedirs(epiphany_profile_path, exist_ok=True)
+            write_file_atomically(new_path, content)
+            os.symlink(new_path, path)
+        else:
+            write_file_atomically(path, content)
+        self.on_launchers_modified()
+
+        return path
 
     def edit_webapp(self, path, name, icon, category):
-        config = configparser.RawConfigParser()
-        config.optionxform = str
-        config.read(path)
-        config.set("Desktop Entry", "Name", name)
-        config.set("Desktop Entry", "Icon", icon)
-        config.set("Desktop Entry", "Categories", "GTK;%s;" % category)
-        with open(path, 'w') as configfile:
-            config.write(configfile, space_around_delimiters=False)
-
-import bs4
-import sys
-import urllib.error
+        # Epiphany launchers are symlinks, the file they point to is edited
+        path = os.path.realpath(path)
+        with open(path) as desktop_file:
+            content = desktop_file.read()
+        content = set_desktop_entry_keys(content, [("Name", name), ("Icon", icon), ("Categories", "GTK;%s;" % category)])
+        write_file_atomically(path, content)
+        self.on_launchers_modified()
+
+    # Changes the URL, the navigation bar or the disk cache of a webapp, in its launcher and profile
+    # (the profile is kept, unlike when the webapp is recreated). None keeps the current value.
+    def edit_webapp_settings(self, webapp, url=None, navbar=None, cache_location=None, cache_size=None):
+        exec_line = webapp.exec
+        if url != None:
+            exec_line = set_launch_url(exec_line, url)
+        if navbar != None and webapp.browser_type == BROWSER_TYPE_FIREFOX:
+            source = FIREFOX_NAVBAR_CSS if navbar else os.path.join(FIREFOX_PROFILE_TEMPLATE, "chrome", "userChrome.css")
+            for profile_path in self.get_profile_paths(webapp):
+                user_chrome_path = os.path.join(profile_path, "chrome", "userChrome.css")
+                if os.path.lexists(user_chrome_path):
+                    os.remove(user_chrome_path)
+                clone_file(source, user_chrome_path)
+        if (cache_location != None or cache_size != None) and webapp.profile != None and \
+           webapp.browser_type in [BROWSER_TYPE_FIREFOX, BROWSER_TYPE_CHROMIUM]:
+            (old_location, old_directory, old_size) = self.get_webapp_cache_settings(webapp)
+            if cache_location == None:
+                cache_location = old_location
+            if cache_size == None:
+                cache_size = old_size if old_size != None else CACHE_SIZE
+            cache_directory = self.get_cache_directory(webapp.profile, cache_location)
+            if webapp.browser_type == BROWSER_TYPE_FIREFOX:
+                prefs = get_firefox_cache_prefs(cache_directory, cache_size)
+                for profile_path in self.get_profile_paths(webapp):
+                    set_firefox_prefs(profile_path, prefs)
+            else:
+                exec_line = set_chromium_cache_args(exec_line, cache_directory, cache_size)
+            if old_directory != None and old_directory != cache_directory:
+                self.move_to_trash(old_directory)
+        if exec_line != webapp.exec:
+            # Epiphany launchers are symlinks, the file they point to is edited
+            path = os.path.realpath(webapp.path)
+            with open(path) as desktop_file:
+                content = desktop_file.read()
+            write_file_atomically(path, set_desktop_entry_keys(content, [("Exec", exec_line)]))
+            self.on_launchers_modified()
+
+# The network and imaging modules (PIL, requests) are only imported when
+# they're needed, to keep them out of the startup time of the application.
+import codecs
+import html.parser
 import urllib.parse
-import urllib.request
-from PIL import Image
 from io import BytesIO
-import requests
-import json
+
+FAVICON_TIMEOUT = 10 # Overall deadline for a favicon search, in seconds
+FAVICON_REQUEST_TIMEOUT = 3 # Maximum timeout of a single request
+FAVICON_WORKERS = 8
+FAVICON_CACHE_TTL = 24 * 3600 # Cached favicons are revalidated after a day
+FAVICON_CACHE_MAX_SIZE = 32 * 1024 * 1024
+PAGE_MAX_SIZE = 512 * 1024 # Only the <head> is parsed, most pages define it in their first few KB
+PAGE_CHUNK_SIZE = 16 * 1024
+IMAGE_MAX_SIZE = 4 * 1024 * 1024 # Bigger images are ignored
+IMAGE_CHUNK_SIZE = 64 * 1024
+ICON_MAX_DIMENSION = 256
+
+http_session = None
+http_session_lock = threading.Lock()
+favicon_executor = None
+
+# Downloads of the favicon searches have their own workers, a search waits for its downloads
+# so they can't be queued behind it (or behind other searches) in the shared task executor
+def get_favicon_executor():
+    global favicon_executor
+    with http_session_lock:
+        if favicon_executor == None:
+            favicon_executor = TaskExecutor(FAVICON_WORKERS, "favicons")
+        return favicon_executor
+
+# Shared HTTP session, connections are kept alive and reused between requests
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session == None:
+            import requests
+            import requests.adapters
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=FAVICON_WORKERS, pool_maxsize=FAVICON_WORKERS)
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+        return http_session
+
+# Returns the timeout to use for a request, so it doesn't exceed the deadline
+def get_request_timeout(deadline):
+    if deadline == None:
+        return FAVICON_REQUEST_TIMEOUT
+    return min(FAVICON_REQUEST_TIMEOUT, deadline - time.monotonic())
 
 def normalize_url(url):
     (scheme, netloc, path, _, _, _) = urllib.parse.urlparse(url, "http")
@@ -221,86 +1399,426 @@ def normalize_url(url):
         return urllib.parse.urlunparse((scheme, path, "", "", "", ""))
     return urllib.parse.urlunparse((scheme, netloc, path, "", "", ""))
 
-def download_image(root_url, link):
+def get_absolute_link(root_url, link):
+    return urllib.parse.urljoin(root_url + "/", link)
+
+# Downloads a file, returns None if it's bigger than max_size
+def download_data(link, timeout, max_size):
+    with tracer.span("fetch image", "favicons", link=link) as span:
+        response = get_http_session().get(link, timeout=timeout, stream=True)
+        span.set("status", response.status_code)
+        try:
+            # Error pages aren't images
+            if response.status_code != 200:
+                return None
+            length = response.headers.get("Content-Length")
+            if length != None and length.isdigit() and int(length) > max_size:
+                print("%s is too big (%s bytes)" % (link, length))
+                span.set("bytes", int(length))
+                return None
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                data += chunk
+                if len(data) > max_size:
+                    print("%s is too big" % link)
+                    span.set("bytes", len(data))
+                    return None
+            span.set("bytes", len(data))
+            return bytes(data)
+        finally:
+            response.close()
+
+# Picks the frame of an ICO/ICNS container which is the closest to ICON_MAX_DIMENSION
+def select_best_frame(image):
+    if image.format == "ICO":
+        frames = [(width, height, 1) for (width, height) in image.ico.sizes()]
+    elif image.format == "ICNS":
+        # ICNS frames are (width, height, scale), their pixel size is width x scale
+        frames = image.info.get("sizes", [])
+    else:
+        return
+    if len(frames) == 0:
+        return
+    # The smallest frame which is big enough, or the biggest one
+    big_enough = [frame for frame in frames if max(frame[0], frame[1]) * frame[2] >= ICON_MAX_DIMENSION]
+    if len(big_enough) > 0:
+        (width, height, scale) = min(big_enough, key=lambda frame: frame[0] * frame[1] * frame[2] ** 2)
+    else:
+        (width, height, scale) = max(frames, key=lambda frame: frame[0] * frame[1] * frame[2] ** 2)
+    image.size = (width, height)
+    if image.format == "ICNS":
+        image.load(scale=scale)
+
+def download_image(root_url, link, deadline=None):
+    try:
+        return fetch_image(root_url, link, deadline)
+    except Exception as e:
+        print(e)
+        print(get_absolute_link(root_url, link))
+        return None
+
+# Same as download_image(), but network errors and the deadline raise an exception,
+# so they can be told apart from links which aren't images
+def fetch_image(root_url, link, deadline=None):
+    from PIL import Image
     image = None
-    if ("://") not in link:
-        if link.startswith("/"):
-            link = root_url + link
-        else:
-            link = root_url + "/" + link
+    link = get_absolute_link(root_url, link)
+    timeout = get_request_timeout(deadline)
+    if timeout <= 0:
+        raise TimeoutError("No time left to download %s" % link)
+    data = download_data(link, timeout, IMAGE_MAX_SIZE)
+    if data == None:
+        return None
     try:
-        response = requests.get(link, timeout=3)
-        image = Image.open(BytesIO(response.content))
-        if image.height > 256:
-            image = image.resize((256, 256), Image.BICUBIC)
+        with tracer.span("decode image", "favicons", link=link) as span:
+            image = Image.open(BytesIO(data))
+            span.set("format", image.format)
+            select_best_frame(image)
+            if image.format == "JPEG":
+                # Let the decoder downscale big pictures (og:image) while decoding them
+                image.draft(image.mode, (ICON_MAX_DIMENSION, ICON_MAX_DIMENSION))
+            image.thumbnail((ICON_MAX_DIMENSION, ICON_MAX_DIMENSION), Image.BICUBIC)
     except Exception as e:
         print(e)
         print(link)
         image = None
     return image
 
-import tempfile
+# Saves the favicon picked by the user into ICONS_DIR, returns its path
+def save_icon(image):
+    import tempfile
+    (fd, path) = tempfile.mkstemp(prefix="favicon-", suffix=".png", dir=ICONS_DIR)
+    with os.fdopen(fd, 'wb') as icon_file:
+        image.save(icon_file, "PNG")
+    return path
 
-def download_favicon(url):
-    images = []
-    url = normalize_url(url)
-    (scheme, netloc, path, _, _, _) = urllib.parse.urlparse(url)
-    root_url = "%s://%s" % (scheme, netloc)
+# Persistent cache of the favicons found for each domain (netloc).
+# Entries are fresh for FAVICON_CACHE_TTL, after that they're revalidated
+# with a conditional request on the page (ETag/Last-Modified).
+# When the cache exceeds its maximum size, the least recently used domains are evicted.
+class FaviconCache():
 
-    # try favicon grabber first
-    try:
-        response = requests.get("https://favicongrabber.com/api/grab/%s?pretty=true" % netloc, timeout=3)
+    def __init__(self, directory=FAVICONS_DIR, ttl=FAVICON_CACHE_TTL, max_size=FAVICON_CACHE_MAX_SIZE):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    # The index is read again (under the lock) before each change, so the changes
+    # made by another process (a purge from the CLI) aren't undone when it's saved
+    def load(self):
+        try:
+            with open(self.index_path) as index_file:
+                self.entries = json.load(index_file)
+        except Exception:
+            self.entries = {}
+
+    def save(self):
+        tmp_path = "%s.%d.tmp" % (self.index_path, threading.get_ident())
+        try:
+            with open(tmp_path, 'w') as index_file:
+                json.dump(self.entries, index_file, indent=1)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(e)
+
+    def get_image_path(self, link):
+        return os.path.join(self.directory, hashlib.sha1(link.encode("UTF-8")).hexdigest() + ".png")
+
+    # Returns the cache entry of a domain (or None)
+    def get(self, netloc):
+        with self.lock:
+            return self.entries.get(netloc)
+
+    def is_fresh(self, entry):
+        return time.time() - entry["time"] < self.ttl
+
+    # Returns the cached images of a domain, as a list of [origin, image]
+    def load_images(self, netloc):
+        from PIL import Image
+        images = []
+        with self.lock:
+            self.load()
+            entry = self.entries.get(netloc)
+            if entry == None:
+                return images
+            entry["access"] = time.time()
+            self.save()
+        for origin, link in entry["candidates"]:
+            try:
+                image = Image.open(self.get_image_path(link))
+                image.load()
+                images.append([origin, image])
+            except Exception as e:
+                print(e)
+        return images
+
+    # Marks an entry as fresh again, after a successful revalidation
+    def refresh(self, netloc):
+        with self.lock:
+            self.load()
+            if netloc in self.entries:
+                self.entries[netloc]["time"] = time.time()
+                self.save()
+
+    # Stores the candidates found for a domain, images is a list of [origin, image, link]
+    def put(self, netloc, validators, images):
+        candidates = []
+        size = 0
+        for origin, image, link in images:
+            try:
+                buffer = BytesIO()
+                image.save(buffer, "PNG")
+                with open(self.get_image_path(link), 'wb') as image_file:
+                    image_file.write(buffer.getvalue())
+                candidates.append([origin, link])
+                size += buffer.tell()
+            except Exception as e:
+                print(e)
+        with self.lock:
+            self.load()
+            now = time.time()
+            self.entries[netloc] = {"time": now, "access": now, "size": size,
+                                    "etag": validators.get("etag"), "last_modified": validators.get("last_modified"),
+                                    "candidates": candidates}
+            self.evict()
+            self.save()
+
+    def evict(self):
+        total = sum(entry["size"] for entry in self.entries.values())
+        for netloc in sorted(self.entries, key=lambda netloc: self.entries[netloc]["access"]):
+            if total <= self.max_size:
+                break
+            total -= self.entries[netloc]["size"]
+            self.remove(netloc)
+
+    def remove(self, netloc):
+        entry = self.entries.pop(netloc)
+        links = set(link for other in self.entries.values() for origin, link in other["candidates"])
+        for origin, link in entry["candidates"]:
+            if link not in links:
+                try:
+                    os.remove(self.get_image_path(link))
+                except OSError:
+                    pass
+
+    # Removes the entry of a domain, or the whole cache
+    def purge(self, netloc=None):
+        with self.lock:
+            self.load()
+            netlocs = list(self.entries.keys()) if netloc == None else [netloc]
+            for netloc in netlocs:
+                if netloc in self.entries:
+                    self.remove(netloc)
+            self.save()
+
+favicon_cache = None
+
+def get_favicon_cache():
+    global favicon_cache
+    with http_session_lock:
+        if favicon_cache == None:
+            favicon_cache = FaviconCache()
+        return favicon_cache
+
+# Returns the icons found by favicongrabber, as a list of (origin, link)
+def get_favicon_grabber_links(netloc, deadline):
+    links = []
+    with tracer.span("fetch favicon grabber", "favicons", netloc=netloc) as span:
+        response = get_http_session().get("https://favicongrabber.com/api/grab/%s?pretty=true" % netloc, timeout=get_request_timeout(deadline))
+        span.set("status", response.status_code)
+        span.set("bytes", len(response.content))
         if response.status_code == 200:
             source = response.content.decode("UTF-8")
             array = json.loads(source)
             for icon in array['icons']:
-                image = download_image(root_url, icon['src'])
-                if image != None:
-                    t = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-                    images.append(["Favicon Grabber", image, t.name])
-                    image.save(t.name)
-        images = sorted(images, key = lambda x: (x[1].height), reverse=True)
-        return images
-    except Exception as e:
-        print(e)
+                links.append(["Favicon Grabber", icon['src']])
+        span.set("links", len(links))
+    return links
+
+# Incremental parser which collects the icons declared in the <head> of a page
+class PageIconParser(html.parser.HTMLParser):
 
-    # Fallback: Check HTML and /favicon.ico
+    ICON_RELS = ["icon", "apple-touch-icon", "apple-touch-icon-precomposed"]
+    ICON_METAS = ["og:image", "msapplication-tileimage"]
+
+    def __init__(self, base_url):
+        html.parser.HTMLParser.__init__(self, convert_charrefs=True)
+        self.base_url = base_url
+        self.links = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict(attrs)
+        if tag == "base" and attrs.get("href"):
+            self.base_url = urllib.parse.urljoin(self.base_url, attrs["href"])
+        elif tag == "link" and attrs.get("href"):
+            rel = (attrs.get("rel") or "").lower()
+            if any(token in self.ICON_RELS for token in rel.split()):
+                # Keep every variant, not just the first one of each kind
+                origin = rel if attrs.get("sizes") == None else "%s %s" % (rel, attrs["sizes"])
+                self.links.append([origin, urllib.parse.urljoin(self.base_url, attrs["href"])])
+        elif tag == "meta" and attrs.get("content"):
+            name = (attrs.get("property") or attrs.get("name") or "").lower()
+            if name in self.ICON_METAS:
+                self.links.append([name, urllib.parse.urljoin(self.base_url, attrs["content"])])
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == "head":
+            self.done = True
+
+# Returns the icons defined in the HTML of the page, as a list of (origin, link)
+def get_page_links(url, deadline, validators):
+    with tracer.span("fetch page", "favicons", url=url):
+        response = get_http_session().get(url, timeout=get_request_timeout(deadline), stream=True)
+        return parse_page_links(response, validators)
+
+# The page is streamed and parsed until the end of its <head>, or PAGE_MAX_SIZE bytes
+def parse_page_links(response, validators):
+    validators["etag"] = response.headers.get("ETag")
+    validators["last_modified"] = response.headers.get("Last-Modified")
+    parser = PageIconParser(response.url)
     try:
-        response = requests.get(url, timeout=3)
-        if response != None:
-            soup = bs4.BeautifulSoup(response.content, "html.parser")
-
-            # icons defined in the HTML
-            for iconformat in ["apple-touch-icon", "shortcut icon", "icon", "msapplication-TileImage"]:
-                item = soup.find("link", {"rel": iconformat})
-                if item != None:
-                    image = download_image(root_url, item["href"])
-                    if image != None:
-                        t = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-                        images.append([iconformat, image, t.name])
-                        image.save(t.name)
-
-            # favicon.ico
-            image = download_image(root_url, "/favicon.ico")
-            if image != None:
-                t = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-                images.append(["favicon", image, t.name])
-                image.save(t.name)
-
-            # OG:IMAGE
-            item = soup.find("meta", {"property": "og:image"})
-            if item != None:
-                image = download_image(root_url, item['content'])
-                if image != None:
-                    t = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-                    images.append(["og:image", image, t.name])
-                    image.save(t.name)
+        decoder = codecs.getincrementaldecoder(response.encoding or "UTF-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("UTF-8")(errors="replace")
+    size = 0
+    with tracer.span("parse page", "favicons", url=response.url, status=response.status_code) as span:
+        try:
+            for chunk in response.iter_content(chunk_size=PAGE_CHUNK_SIZE):
+                parser.feed(decoder.decode(chunk))
+                size += len(chunk)
+                if parser.done or size >= PAGE_MAX_SIZE:
+                    break
+        finally:
+            response.close()
+        span.set("bytes", size)
+        span.set("links", len(parser.links))
+    return parser.links
 
+# Checks whether the page changed since the cache entry was stored.
+# Returns (True, None) if it didn't, (False, response) otherwise.
+def revalidate_page(url, entry, deadline):
+    headers = {}
+    if entry.get("etag") != None:
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified") != None:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    if len(headers) == 0:
+        return (False, None)
+    try:
+        with tracer.span("revalidate page", "favicons", url=url) as span:
+            response = get_http_session().get(url, headers=headers, timeout=get_request_timeout(deadline), stream=True)
+            span.set("status", response.status_code)
+        if response.status_code != 200:
+            response.close()
+        return (response.status_code == 304, response)
     except Exception as e:
         print(e)
+        return (False, None)
+
+# Yields the favicons of a website as [origin, image], as soon as they're downloaded.
+# Duplicates (same link or same pixels) are only yielded once.
+def iter_favicons(url, timeout=FAVICON_TIMEOUT):
+    images = []
+    url = normalize_url(url)
+    (scheme, netloc, path, _, _, _) = urllib.parse.urlparse(url)
+    root_url = "%s://%s" % (scheme, netloc)
+    deadline = time.monotonic() + timeout
+
+    # Try the cache first, fresh entries cost no request at all,
+    # stale ones are revalidated with a single conditional request.
+    cache = get_favicon_cache()
+    entry = cache.get(netloc)
+    response = None
+    if entry != None:
+        not_modified = cache.is_fresh(entry)
+        if not not_modified:
+            (not_modified, response) = revalidate_page(url, entry, deadline)
+            if not_modified:
+                cache.refresh(netloc)
+        if not_modified:
+            cached_images = cache.load_images(netloc)
+            if len(cached_images) >= len(entry["candidates"]):
+                yield from cached_images
+                return
+            # Some images are missing from the cache directory, the domain is searched again
+            cache.purge(netloc)
+
+    def fetch(origin, link):
+        image = fetch_image(root_url, link, deadline)
+        if image == None:
+            return None
+        checksum = hashlib.sha1(image.tobytes()).digest()
+        return [origin, image, link, (image.size, checksum)]
+
+    # All sources and candidate images are fetched concurrently,
+    # the search stops when everything is done or when the deadline is reached.
+    validators = {}
+    executor = get_favicon_executor()
+    if response != None and response.status_code == 200:
+        page_source = executor.submit(parse_page_links, response, validators)
+    else:
+        page_source = executor.submit(get_page_links, url, deadline, validators)
+    sources = [executor.submit(get_favicon_grabber_links, netloc, deadline),
+               page_source,
+               executor.submit(lambda: [["favicon", "/favicon.ico"]])]
+    pending = set(sources)
+    links = set()
+    checksums = set()
+    # Whether every source was fetched in time, only complete results are cached
+    complete = True
+    try:
+        while len(pending) > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                complete = False
+                break
+            done, pending = concurrent.futures.wait(pending, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(e)
+                    # A site can link to icons which don't exist, only a failed source (or a download
+                    # which ran out of time) makes the results incomplete
+                    if future in sources or time.monotonic() >= deadline:
+                        complete = False
+                    continue
+                if future in sources:
+                    for origin, link in result:
+                        link = get_absolute_link(root_url, link)
+                        if link not in links:
+                            links.add(link)
+                            pending.add(executor.submit(fetch, origin, link))
+                elif result != None:
+                    origin, image, link, checksum = result
+                    if checksum not in checksums:
+                        checksums.add(checksum)
+                        images.append([origin, image, link])
+                        yield [origin, image]
+    finally:
+        # Downloads which already started finish in the background, their results are ignored
+        for future in pending:
+            future.cancel()
+
+    # Incomplete results (slow site, network error) aren't cached, so the next search tries again.
+    # A previous entry of the domain is kept, it's revalidated by the next search.
+    if complete and len(images) > 0:
+        images = sorted(images, key = lambda x: (x[1].height), reverse=True)
+        cache.put(netloc, validators, images)
 
+def download_favicon(url, timeout=FAVICON_TIMEOUT):
+    images = list(iter_favicons(url, timeout))
     images = sorted(images, key = lambda x: (x[1].height), reverse=True)
     return images
 
 if __name__ == "__main__":
-    download_favicon(sys.argv[1])
\ No newline at end of file
+    download_favicon(sys.argv[1])
@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+# Command-line interface, applies a manifest of webapps without the GTK window.
+#
+# The manifest is a JSON (or YAML, if PyYAML is installed) file:
+#
+#   {
+#     "defaults": {"browser": "Firefox", "category": "WebApps"},
+#     "prune": false,
+#     "webapps": [
+#       {"name": "Mail", "url": "https://mail.example.com", "category": "Network",
+#        "browser": "Chromium", "isolated": true, "icon": "mail-client"},
+#       {"name": "Docs", "url": "docs.example.com", "navbar": true, "cache-location": "runtime"}
+#     ]
+#   }
+#
+# Webapps are identified by their name. The ones which are missing are created,
+# the ones which differ are edited (or recreated if their browser or profile isolation
+# changed), and with "prune" (or --prune) the webapps which aren't in the
+# manifest are deleted.
+# When no icon is given, the favicon of the website is used.
+#
+# Usage: webapp-manager-cli [apply] [--dry-run] [--prune] [--jobs N] manifest.json
+#
+# The cache of the favicon searches can also be inspected and purged:
+#
+# Usage: webapp-manager-cli favicon-cache list
+#        webapp-manager-cli favicon-cache purge [domain]
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+from common import TaskExecutor, WebAppManager, download_favicon, get_favicon_cache, save_icon
+from common import BROWSER_TYPE_CHROMIUM, BROWSER_TYPE_FIREFOX, CACHE_LOCATION_PROFILE, CACHE_LOCATION_RUNTIME, CACHE_LOCATION_SHARED, CACHE_SIZE
+
+DEFAULT_ICON = "webapp-manager"
+DEFAULT_CATEGORY = "WebApps"
+SETTINGS_SCHEMA = "org.x.webapp-manager"
+JOBS = 8
+
+ACTION_CREATE, ACTION_EDIT, ACTION_REPLACE, ACTION_DELETE = ["create", "edit", "replace", "delete"]
+ACTION_SYMBOLS = {ACTION_CREATE: "+", ACTION_EDIT: "~", ACTION_REPLACE: "!", ACTION_DELETE: "-"}
+COMMANDS = ["apply", "favicon-cache"]
+
+class ManifestError(Exception):
+    pass
+
+# A change to apply to a webapp (old is the existing launcher, new the manifest entry)
+class Change():
+
+    def __init__(self, action, old=None, new=None, details=None):
+        self.action = action
+        self.old = old
+        self.new = new
+        self.details = details if details != None else []
+
+    def get_name(self):
+        return self.new["name"] if self.new != None else self.old.name
+
+    def __str__(self):
+        line = "%s %s" % (ACTION_SYMBOLS[self.action], self.get_name())
+        if self.action == ACTION_CREATE:
+            line += " (%s)" % self.new["url"]
+        for key, old_value, new_value in self.details:
+            line += "\n    %s: %s -> %s" % (key, old_value, new_value)
+        return line
+
+def load_manifest(path):
+    if path == "-":
+        content = sys.stdin.read()
+    else:
+        with open(path) as manifest_file:
+            content = manifest_file.read()
+    if path.endswith(".yaml") or path.endswith(".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ManifestError("PyYAML is needed to read YAML manifests")
+        manifest = yaml.safe_load(content)
+    else:
+        manifest = json.loads(content)
+    # A list of webapps on its own is also accepted
+    if isinstance(manifest, list):
+        manifest = {"webapps": manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("webapps", []), list):
+        raise ManifestError("The manifest should contain a list of webapps")
+    return manifest
+
+def normalize_url(url):
+    url = url.strip()
+    if not "://" in url:
+        url = "http://%s" % url
+    return url
+
+# Reads the settings of the application, so webapps are configured like the ones created in the window.
+# Returns the defaults of the manifest entries, the shared cache directory is set on the manager.
+def load_settings(manager):
+    defaults = {"cache-location": CACHE_LOCATION_PROFILE, "cache-size": CACHE_SIZE}
+    try:
+        from gi.repository import Gio
+        # Gio.Settings aborts if the schema isn't installed
+        source = Gio.SettingsSchemaSource.get_default()
+        if source == None or source.lookup(SETTINGS_SCHEMA, True) == None:
+            return defaults
+        settings = Gio.Settings(schema_id=SETTINGS_SCHEMA)
+    except Exception as e:
+        print(e)
+        return defaults
+    defaults["cache-location"] = settings.get_string("cache-location")
+    defaults["cache-size"] = settings.get_int("cache-size")
+    shared_cache_directory = settings.get_string("shared-cache-directory")
+    if shared_cache_directory != "":
+        manager.shared_cache_directory = os.path.expanduser(shared_cache_directory)
+    return defaults
+
+# Resolves the entries of the manifest (defaults, browser, URL...)
+def get_entries(manifest, browsers, settings_defaults):
+    defaults = manifest.get("defaults", {})
+    entries = []
+    names = set()
+    for item in manifest.get("webapps", []):
+        entry = dict(defaults)
+        entry.update(item)
+        # Existing webapps are only compared on the settings the manifest specifies,
+        # so changing the settings of the application doesn't recreate them
+        entry["specified"] = set(entry.keys())
+        name = entry.get("name")
+        if not name or not entry.get("url"):
+            raise ManifestError("Each webapp needs a name and a URL: %s" % json.dumps(item))
+        if name in names:
+            raise ManifestError("Duplicate webapp: %s" % name)
+        names.add(name)
+        entry["url"] = normalize_url(entry["url"])
+        entry.setdefault("category", DEFAULT_CATEGORY)
+        entry.setdefault("isolated", True)
+        entry.setdefault("navbar", False)
+        entry.setdefault("cache-location", settings_defaults["cache-location"])
+        entry.setdefault("cache-size", settings_defaults["cache-size"])
+        if entry["cache-location"] not in [CACHE_LOCATION_PROFILE, CACHE_LOCATION_RUNTIME, CACHE_LOCATION_SHARED]:
+            raise ManifestError("Invalid cache location for %s: %s" % (name, entry["cache-location"]))
+        browser_name = entry.get("browser")
+        if browser_name == None:
+            if len(browsers) == 0:
+                raise ManifestError("No supported browser is installed")
+            entry["browser"] = browsers[0]
+        else:
+            matches = [browser for browser in browsers if browser.name.lower() == browser_name.lower()]
+            if len(matches) == 0:
+                raise ManifestError("Browser not installed or not supported for %s: %s" % (name, browser_name))
+            entry["browser"] = matches[0]
+        entries.append(entry)
+    return entries
+
+# Compares the manifest with the existing webapps, returns the list of changes
+def get_changes(manager, webapps, entries, prune):
+    existing = {}
+    for webapp in webapps:
+        existing.setdefault(webapp.name, []).append(webapp)
+
+    changes = []
+    for entry in entries:
+        matches = existing.pop(entry["name"], [])
+        # Extra webapps with the same name are treated as if they weren't in the manifest
+        for webapp in matches[1:]:
+            existing.setdefault(None, []).append(webapp)
+        if len(matches) == 0:
+            changes.append(Change(ACTION_CREATE, new=entry))
+            continue
+        webapp = matches[0]
+        browser = entry["browser"]
+        details = []
+        if webapp.url != entry["url"]:
+            details.append(("url", webapp.url, entry["url"]))
+        replace = True
+        if webapp.browser_type != browser.browser_type or \
+           webapp.exec == None or webapp.exec.split(" ")[0] != browser.exec_path:
+            details.append(("browser", webapp.exec.split(" ")[0] if webapp.exec != None else None, browser.exec_path))
+        elif browser.browser_type == BROWSER_TYPE_CHROMIUM and webapp.is_isolated != bool(entry["isolated"]):
+            details.append(("isolated", webapp.is_isolated, bool(entry["isolated"])))
+        else:
+            replace = False
+            details.extend(get_profile_changes(manager, webapp, entry))
+        if replace:
+            # The profile belongs to the browser, the webapp is recreated
+            changes.append(Change(ACTION_REPLACE, old=webapp, new=entry, details=details))
+            continue
+        if webapp.category != entry["category"]:
+            details.append(("category", webapp.category, entry["category"]))
+        if entry.get("icon") != None and webapp.icon != entry["icon"]:
+            details.append(("icon", webapp.icon, entry["icon"]))
+        if len(details) > 0:
+            changes.append(Change(ACTION_EDIT, old=webapp, new=entry, details=details))
+
+    if prune:
+        for name, webapps in sorted(existing.items(), key=lambda x: str(x[0])):
+            for webapp in webapps:
+                changes.append(Change(ACTION_DELETE, old=webapp))
+    return changes
+
+# Compares the profile settings of a webapp (navigation bar, disk cache) with its manifest entry.
+# Only the settings used by its browser, and given in the manifest, are compared (see WebAppManager.create_webapp()).
+def get_profile_changes(manager, webapp, entry):
+    details = []
+    browser = entry["browser"]
+    specified = entry["specified"]
+    if browser.browser_type == BROWSER_TYPE_FIREFOX and "navbar" in specified and \
+       manager.has_navbar(webapp) != bool(entry["navbar"]):
+        details.append(("navbar", not entry["navbar"], bool(entry["navbar"])))
+    if browser.browser_type == BROWSER_TYPE_FIREFOX or (browser.browser_type == BROWSER_TYPE_CHROMIUM and entry["isolated"]):
+        (cache_location, cache_directory, cache_size) = manager.get_webapp_cache_settings(webapp)
+        if "cache-location" in specified and cache_location != entry["cache-location"]:
+            details.append(("cache-location", cache_location, entry["cache-location"]))
+        elif "cache-size" in specified and cache_location != CACHE_LOCATION_PROFILE and cache_size != int(entry["cache-size"]):
+            details.append(("cache-size", cache_size, int(entry["cache-size"])))
+    return details
+
+# Returns the path of the favicon of a website, or the default icon
+def get_favicon(url):
+    try:
+        images = download_favicon(url)
+        if len(images) > 0:
+            return save_icon(images[0][1])
+    except Exception as e:
+        print(e)
+    return DEFAULT_ICON
+
+def apply_change(manager, change):
+    entry = change.new
+    if change.action == ACTION_DELETE:
+        manager.delete_webbapp(change.old)
+    elif change.action == ACTION_EDIT:
+        # The URL, the navigation bar and the disk cache are changed in place, the profile is kept
+        changed = [key for key, old_value, new_value in change.details]
+        if any(key in changed for key in ["url", "navbar", "cache-location", "cache-size"]):
+            cache_size = int(entry["cache-size"]) if "cache-location" in changed or "cache-size" in changed else None
+            manager.edit_webapp_settings(change.old,
+                                         entry["url"] if "url" in changed else None,
+                                         bool(entry["navbar"]) if "navbar" in changed else None,
+                                         entry["cache-location"] if "cache-location" in changed else None,
+                                         cache_size)
+        icon = entry["icon"] if entry.get("icon") != None else change.old.icon
+        manager.edit_webapp(change.old.path, entry["name"], icon, entry["category"])
+    else:
+        if change.action == ACTION_REPLACE:
+            manager.delete_webbapp(change.old)
+        manager.create_webapp(entry["name"], entry["url"], entry["icon"], entry["category"], entry["browser"],
+                              bool(entry["isolated"]), bool(entry["navbar"]), entry["cache-location"], int(entry["cache-size"]))
+
+def apply_changes(manager, changes, jobs):
+    errors = 0
+    # Daemon workers, a stuck download doesn't keep the command from exiting
+    executor = TaskExecutor(jobs, "cli")
+    # Favicons are downloaded in parallel, for the new webapps which don't specify an icon
+    # (recreated webapps keep their icon)
+    new_entries = []
+    for change in changes:
+        if change.action in [ACTION_CREATE, ACTION_REPLACE]:
+            new_entries.append(change.new)
+            if change.new.get("icon") == None:
+                if change.action == ACTION_REPLACE:
+                    change.new["icon"] = change.old.icon
+                else:
+                    change.new["icon"] = executor.submit(get_favicon, change.new["url"])
+    for entry in new_entries:
+        if isinstance(entry["icon"], concurrent.futures.Future):
+            entry["icon"] = entry["icon"].result()
+
+    # Profiles are created (and moved to the trash) concurrently
+    futures = {executor.submit(apply_change, manager, change): change for change in changes}
+    for future in concurrent.futures.as_completed(futures):
+        change = futures[future]
+        try:
+            future.result()
+            print(change)
+        except Exception as e:
+            print("Failed to %s %s: %s" % (change.action, change.get_name(), e), file=sys.stderr)
+            errors += 1
+    return errors
+
+def list_favicon_cache(args):
+    cache = get_favicon_cache()
+    for netloc, entry in sorted(cache.entries.items()):
+        age = (time.time() - entry["time"]) / 3600
+        status = "fresh" if cache.is_fresh(entry) else "stale"
+        print("%s: %d icons, %d bytes, %.1f hours old (%s)" % (netloc, len(entry["candidates"]), entry["size"], age, status))
+
+def purge_favicon_cache(args):
+    cache = get_favicon_cache()
+    if args.domain != None and args.domain not in cache.entries:
+        print("%s is not in the favicon cache" % args.domain, file=sys.stderr)
+        sys.exit(1)
+    cache.purge(args.domain)
+
+def apply_manifest(args):
+    manager = WebAppManager()
+    settings_defaults = load_settings(manager)
+    browsers = [browser for browser in manager.get_supported_browsers() if os.path.exists(browser.test_path)]
+    try:
+        manifest = load_manifest(args.manifest)
+        entries = get_entries(manifest, browsers, settings_defaults)
+    except (OSError, ValueError, ManifestError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    # The launchers are scanned once, all the changes are computed from this scan
+    changes = get_changes(manager, manager.get_webapps(), entries, args.prune or bool(manifest.get("prune", False)))
+    if args.dry_run:
+        for change in changes:
+            print(change)
+        print("%d changes" % len(changes))
+        return
+
+    # The menus are only refreshed once, at the end of the batch
+    with manager.batch():
+        errors = apply_changes(manager, changes, max(1, args.jobs))
+    if len(changes) > 0:
+        # Deleted profiles are removed before exiting
+        manager.empty_trash().result()
+    print("%d changes, %d errors" % (len(changes), errors))
+    if errors > 0:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage webapps from the command line")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    apply_parser = commands.add_parser("apply", help="create, edit and delete webapps from a manifest")
+    apply_parser.add_argument("manifest", help="JSON or YAML manifest (- to read JSON from the standard input)")
+    apply_parser.add_argument("-n", "--dry-run", action="store_true", help="only show the changes which would be made")
+    apply_parser.add_argument("--prune", action="store_true", help="delete the webapps which aren't in the manifest")
+    apply_parser.add_argument("-j", "--jobs", type=int, default=JOBS, help="number of webapps to process in parallel")
+    apply_parser.set_defaults(func=apply_manifest)
+
+    cache_parser = commands.add_parser("favicon-cache", help="inspect or purge the cache of the favicon searches")
+    cache_commands = cache_parser.add_subparsers(dest="cache_command", metavar="action")
+    cache_commands.required = True
+    cache_commands.add_parser("list", help="list the cached domains").set_defaults(func=list_favicon_cache)
+    purge_parser = cache_commands.add_parser("purge", help="remove a domain, or every domain, from the cache")
+    purge_parser.add_argument("domain", nargs="?", help="domain (as listed), the whole cache is purged if omitted")
+    purge_parser.set_defaults(func=purge_favicon_cache)
+
+    argv = sys.argv[1:]
+    # "webapp-manager-cli manifest.json" is short for "webapp-manager-cli apply manifest.json"
+    if len(argv) > 0 and argv[0] not in COMMANDS and argv[0] not in ["-h", "--help"]:
+        argv.insert(0, "apply")
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
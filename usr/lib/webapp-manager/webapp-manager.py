@@ -1,4 +1,5 @@
 #!/usr/bin/python3
+import functools
 import gettext
 import gi
 import locale
@@ -6,8 +7,8 @@ import os
 import re
 import setproctitle
 import shutil
-import subprocess
-import tldextract
+import time
+import urllib.parse
 import warnings
 
 # Suppress GTK deprecation warnings
@@ -17,7 +18,8 @@ gi.require_version("Gtk", "3.0")
 gi.require_version('XApp', '1.0')
 from gi.repository import Gtk, Gdk, Gio, XApp, GdkPixbuf, GLib
 
-from common import _async, idle, WebAppManager, Browser, download_favicon, ICONS_DIR, BROWSER_TYPE_FIREFOX
+from common import _async, idle, WebAppManager, Browser, FileCache, iter_favicons, save_icon, APPS_DIR, ICONS_DIR, THUMBNAILS_DIR, BROWSER_TYPE_FIREFOX, BROWSER_TYPE_EPIPHANY
+from common import tracer, get_task_executor, TaskExecutor, CACHE_LOCATION_PROFILE, CACHE_LOCATION_RUNTIME, CACHE_LOCATION_SHARED
 
 setproctitle.setproctitle("webapp-manager")
 
@@ -29,9 +31,55 @@ gettext.bindtextdomain(APP, LOCALE_DIR)
 gettext.textdomain(APP)
 _ = gettext.gettext
 
-COL_ICON, COL_NAME, COL_WEBAPP = range(3)
+COL_ICON, COL_NAME, COL_WEBAPP, COL_SIZE, COL_VISIBLE = range(5)
 CATEGORY_ID, CATEGORY_NAME = range(2)
 BROWSER_OBJ, BROWSER_NAME = range(2)
+CACHE_LOCATION_ID, CACHE_LOCATION_NAME = range(2)
+ICON_SIZE = 32
+ICON_WORKERS = 4 # icons are decoded by their own workers, so a long list doesn't hold up the other tasks
+THUMBNAILS_MAX_SIZE = 16 * 1024 * 1024
+GUESS_ICON_DELAY = 250 # ms of inactivity in the URL entry before guessing its icon
+LAUNCH_TIMEOUT = 60 # seconds to wait for the window of a launched webapp
+PREWARM_LEARN_DELAY = 30 # seconds after a launch, when the files used by the browser are recorded
+LAUNCHER_CHANGES_DELAY = 100 # ms during which the file monitor events of the launchers are coalesced
+INDEX_SAVE_DELAY = 5 # seconds after a launcher changed, when the launcher index is saved
+
+tld_extractor = None
+
+# Uses the public suffix list snapshot bundled with tldextract, it never goes online
+def get_tld_extractor():
+    global tld_extractor
+    if tld_extractor == None:
+        import tldextract
+        tld_extractor = tldextract.TLDExtract(suffix_list_urls=())
+    return tld_extractor
+
+# Returns the window class a webapp was started with (--class X or --class=X)
+def get_window_class(argv):
+    for i, argument in enumerate(argv):
+        if argument.startswith("--class="):
+            return argument[len("--class="):]
+        if argument == "--class" and i + 1 < len(argv):
+            return argv[i + 1]
+    return None
+
+# Returns the name of the themed icon matching a domain (it might not exist in the theme)
+@functools.lru_cache(maxsize=256)
+def get_icon_name(hostname):
+    info = get_tld_extractor()(hostname)
+    icon = None
+    if info.domain == "google" and info.subdomain != None and info.subdomain != "":
+        if info.subdomain == "mail":
+            icon = "web-%s-gmail" % info.domain
+        else:
+            icon = "web-%s-%s" % (info.domain, info.subdomain)
+    elif info.domain == "gmail":
+        icon = "web-google-gmail"
+    elif info.domain == "youtube":
+        icon = "web-google-youtube"
+    elif info.domain != None and info.domain != "":
+        icon = "web-%s" % info.domain
+    return icon
 
 class MyApplication(Gtk.Application):
     # Main initialization routine
@@ -56,9 +104,19 @@ class WebAppManagerWindow():
 
         self.application = application
         self.settings = Gio.Settings(schema_id="org.x.webapp-manager")
+        if self.settings.get_boolean("trace"):
+            tracer.enable()
         self.manager = WebAppManager()
         self.selected_webapp = None
+        self.favicon_path = None # Icon picked on the favicon page, until the webapp is saved
         self.icon_theme = Gtk.IconTheme.get_default()
+        self.icon_theme.connect("changed", self.on_icon_theme_changed)
+        self.web_icons = None # Names of the web-* icons in the icon theme
+        self.guess_icon_source = None
+        self.thumbnails = FileCache(THUMBNAILS_DIR, THUMBNAILS_MAX_SIZE)
+        self.icon_executor = TaskExecutor(ICON_WORKERS, "icons")
+        self.placeholder_pixbufs = {} # scale factor -> pixbuf
+        self.surfaces = {} # launcher path -> (pixbuf, cairo surface)
 
         # Set the Glade file
         gladefile = "/usr/share/webapp-manager/webapp-manager.ui"
@@ -68,6 +126,7 @@ class WebAppManagerWindow():
         self.window = self.builder.get_object("main_window")
         self.window.set_title(_("Web Apps"))
         self.window.set_icon_name("webapp-manager")
+        self.window.connect("notify::scale-factor", self.on_scale_factor_changed)
         self.stack = self.builder.get_object("stack")
         self.icon_chooser = XApp.IconChooserButton()
         self.builder.get_object("icon_button_box").pack_start(self.icon_chooser, 0, True, True)
@@ -81,6 +140,7 @@ class WebAppManagerWindow():
         self.remove_button = self.builder.get_object("remove_button")
         self.edit_button = self.builder.get_object("edit_button")
         self.run_button = self.builder.get_object("run_button")
+        self.compact_button = self.builder.get_object("compact_button")
         self.ok_button = self.builder.get_object("ok_button")
         self.name_entry = self.builder.get_object("name_entry")
         self.url_entry = self.builder.get_object("url_entry")
@@ -89,16 +149,21 @@ class WebAppManagerWindow():
         self.isolated_label = self.builder.get_object("isolated_label")
         self.navbar_switch = self.builder.get_object("navbar_switch")
         self.navbar_label = self.builder.get_object("navbar_label")
+        self.cache_combo = self.builder.get_object("cache_combo")
+        self.cache_label = self.builder.get_object("cache_label")
         self.spinner = self.builder.get_object("spinner")
         self.favicon_stack = self.builder.get_object("favicon_stack")
         self.browser_combo = self.builder.get_object("browser_combo")
         self.browser_label = self.builder.get_object("browser_label")
+        self.favicon_flow = self.builder.get_object("favicon_flow")
+        self.favicon_flow.set_sort_func(self.sort_favicons)
 
         # Widgets which are in the add page but not the edit page
         self.add_specific_widgets = [self.url_label, self.url_entry, self.favicon_button,
                                      self.browser_label, self.browser_combo,
                                      self.isolated_label, self.isolated_switch,
-                                     self.navbar_label, self.navbar_switch]
+                                     self.navbar_label, self.navbar_switch,
+                                     self.cache_label, self.cache_combo]
 
         # Widget signals
         self.add_button.connect("clicked", self.on_add_button)
@@ -107,6 +172,7 @@ class WebAppManagerWindow():
         self.remove_button.connect("clicked", self.on_remove_button)
         self.edit_button.connect("clicked", self.on_edit_button)
         self.run_button.connect("clicked", self.on_run_button)
+        self.compact_button.connect("clicked", self.on_compact_button)
         self.ok_button.connect("clicked", self.on_ok_button)
         self.favicon_button.connect("clicked", self.on_favicon_button)
         self.name_entry.connect("changed", self.on_name_entry)
@@ -118,6 +184,11 @@ class WebAppManagerWindow():
         self.window.add_accel_group(accel_group)
         menu = self.builder.get_object("main_menu")
         item = Gtk.ImageMenuItem()
+        item.set_image(Gtk.Image.new_from_icon_name("edit-clear-all-symbolic", Gtk.IconSize.MENU))
+        item.set_label(_("Clear All Caches"))
+        item.connect("activate", self.on_menu_compact)
+        menu.append(item)
+        item = Gtk.ImageMenuItem()
         item.set_image(Gtk.Image.new_from_icon_name("preferences-desktop-keyboard-shortcuts-symbolic", Gtk.IconSize.MENU))
         item.set_label(_("Keyboard Shortcuts"))
         item.connect("activate", self.open_keyboard_shortcuts)
@@ -152,11 +223,31 @@ class WebAppManagerWindow():
         column = Gtk.TreeViewColumn("", Gtk.CellRendererText(), text=COL_NAME)
         column.set_sort_column_id(COL_NAME)
         column.set_resizable(True)
+        column.set_expand(True)
+        self.treeview.append_column(column)
+
+        renderer = Gtk.CellRendererText(xalign=1.0)
+        renderer.set_property("foreground-rgba", Gdk.RGBA(0.5, 0.5, 0.5, 1.0))
+        column = Gtk.TreeViewColumn("", renderer, text=COL_SIZE)
         self.treeview.append_column(column)
         self.treeview.show()
-        self.model = Gtk.TreeStore(GdkPixbuf.Pixbuf, str, object) # icon, name, webapp
+        self.model = Gtk.TreeStore(GdkPixbuf.Pixbuf, str, object, str, bool) # icon, name, webapp, profile size, visible
         self.model.set_sort_column_id(COL_NAME, Gtk.SortType.ASCENDING)
-        self.treeview.set_model(self.model)
+        self.webapp_rows = {} # launcher path -> row iter
+        # The search hides rows through the visible column, so the filter never calls back into Python
+        self.filter = self.model.filter_new()
+        self.filter.set_visible_column(COL_VISIBLE)
+        self.search_query = ""
+        self.search_terms = []
+        self.search_keys = {} # launcher path -> casefolded search key of the webapp
+        self.matching_paths = set() # launcher paths of the visible rows
+        self.wnck_screen = None # loaded on the first launch (False if unavailable)
+        self.pending_launches = {} # window class -> (webapp name, launch time, trace span, prewarmed)
+        self.treeview.set_model(self.filter)
+        self.search_entry = self.builder.get_object("search_entry")
+        self.search_entry.connect("search-changed", self.on_search_changed)
+        self.search_entry.connect("stop-search", self.on_stop_search)
+        self.search_entry.connect("activate", self.on_search_activated)
         self.treeview.get_selection().connect("changed", self.on_webapp_selected)
         self.treeview.connect("row-activated", self.on_webapp_activated)
 
@@ -193,17 +284,56 @@ class WebAppManagerWindow():
             self.browser_label.hide()
             self.browser_combo.hide()
         self.browser_combo.connect("changed", self.on_browser_changed)
+        self.isolated_switch.connect("notify::active", self.on_isolated_changed)
+
+        cache_model = Gtk.ListStore(str, str) # CACHE_LOCATION_ID, CACHE_LOCATION_NAME
+        cache_model.append([CACHE_LOCATION_PROFILE, _("In the profile")])
+        cache_model.append([CACHE_LOCATION_RUNTIME, _("In memory")])
+        cache_model.append([CACHE_LOCATION_SHARED, _("In the shared cache directory")])
+        renderer = Gtk.CellRendererText()
+        self.cache_combo.pack_start(renderer, True)
+        self.cache_combo.add_attribute(renderer, "text", CACHE_LOCATION_NAME)
+        self.cache_combo.set_model(cache_model)
+        self.cache_combo.set_id_column(CACHE_LOCATION_ID)
+        self.cache_combo.set_active(0)
+        shared_cache_directory = self.settings.get_string("shared-cache-directory")
+        if shared_cache_directory != "":
+            self.manager.shared_cache_directory = os.path.expanduser(shared_cache_directory)
 
-        self.load_webapps()
+        # Scan the launchers once the window is painted, so it shows up straight away
+        GLib.idle_add(self.load_webapps, priority=GLib.PRIORITY_LOW)
+
+        # Keep the list in sync with launchers and icons, including the ones modified by other tools
+        self.changed_launchers = set() # paths of the launchers which changed since the list was updated
+        self.launcher_changes_source = None
+        self.index_save_source = None
+        self.application.connect("shutdown", self.on_shutdown)
+        self.monitors = []
+        for directory, callback in [(APPS_DIR, self.on_apps_dir_changed), (ICONS_DIR, self.on_icons_dir_changed)]:
+            monitor = Gio.File.new_for_path(directory).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            monitor.connect("changed", callback)
+            self.monitors.append(monitor)
 
         # Used by the OK button, indicates whether we're editing a web-app or adding a new one.
         self.edit_mode = False
 
+    # Surfaces are cached per row, they're only created again when the row's icon changes
     def data_func_surface(self, column, cell, model, iter_, *args):
         pixbuf = model.get_value(iter_, COL_ICON)
-        surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, self.window.get_scale_factor())
+        path = model.get_value(iter_, COL_WEBAPP).path
+        cached = self.surfaces.get(path)
+        if cached != None and cached[0] == pixbuf:
+            surface = cached[1]
+        else:
+            surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, self.window.get_scale_factor())
+            self.surfaces[path] = (pixbuf, surface)
         cell.set_property("surface", surface)
 
+    def on_scale_factor_changed(self, window, param):
+        self.surfaces.clear()
+        for iter in self.webapp_rows.values():
+            self.load_webapp_icon(self.model.get_value(iter, COL_WEBAPP))
+
     def open_keyboard_shortcuts(self, widget):
         gladefile = "/usr/share/webapp-manager/shortcuts.ui"
         builder = Gtk.Builder()
@@ -243,6 +373,10 @@ class WebAppManagerWindow():
     def on_menu_quit(self, widget):
         self.application.quit()
 
+    def on_shutdown(self, application):
+        if self.manager.index.dirty:
+            self.manager.index.save()
+
     def on_webapp_selected(self, selection):
         model, iter = selection.get_selected()
         if iter is not None:
@@ -250,10 +384,18 @@ class WebAppManagerWindow():
             self.remove_button.set_sensitive(True)
             self.edit_button.set_sensitive(True)
             self.run_button.set_sensitive(True)
+            # Webapps without their own profile (non-isolated Chromium apps) have nothing to compact
+            self.compact_button.set_sensitive(len(self.manager.get_profile_paths(self.selected_webapp)) > 0)
+        else:
+            self.selected_webapp = None
+            self.remove_button.set_sensitive(False)
+            self.edit_button.set_sensitive(False)
+            self.run_button.set_sensitive(False)
+            self.compact_button.set_sensitive(False)
 
     def on_webapp_activated(self, treeview, path, column):
         if self.selected_webapp != None:
-            subprocess.Popen(self.selected_webapp.exec, shell=True)
+            self.launch_webapp(self.selected_webapp)
 
     def on_key_press_event(self, widget, event):
         ctrl = (event.state & Gdk.ModifierType.CONTROL_MASK)
@@ -264,17 +406,137 @@ class WebAppManagerWindow():
                 self.on_edit_button(self.edit_button)
             elif event.keyval == Gdk.KEY_d:
                 self.on_remove_button(self.remove_button)
+            elif event.keyval == Gdk.KEY_f:
+                self.search_entry.grab_focus()
         elif event.keyval == Gdk.KEY_Escape:
             self.load_webapps()
+        elif self.stack.get_visible_child_name() == "main_page" and self.treeview.has_focus():
+            # Typing in the list starts a search
+            if self.search_entry.handle_event(event):
+                self.search_entry.grab_focus_without_selecting()
+                self.search_entry.set_position(-1)
+                return True
 
     def on_remove_button(self, widget):
         if self.selected_webapp != None:
             self.manager.delete_webbapp(self.selected_webapp)
-            self.load_webapps()
+            self.remove_webapp_row(self.selected_webapp.path)
+            self.select_first_webapp()
+
+    def on_compact_button(self, widget):
+        if self.selected_webapp != None:
+            self.compact_webapps([self.selected_webapp])
+
+    def on_menu_compact(self, widget):
+        self.compact_webapps([self.model.get_value(iter, COL_WEBAPP) for iter in self.webapp_rows.values()])
+
+    @_async
+    def compact_webapps(self, webapps):
+        reclaimed = 0
+        skipped = []
+        for webapp in webapps:
+            size = self.manager.compact_webapp(webapp)
+            if size == None:
+                skipped.append(webapp.name)
+            else:
+                reclaimed += size
+            self.set_webapp_size(webapp, self.manager.get_disk_usage(webapp))
+        self.manager.disk_usage.save()
+        self.show_compact_result(reclaimed, skipped)
+
+    @idle
+    def show_compact_result(self, reclaimed, skipped):
+        dialog = Gtk.MessageDialog(transient_for=self.window, modal=True, message_type=Gtk.MessageType.INFO,
+                                   buttons=Gtk.ButtonsType.OK, text=_("Cache cleared"))
+        text = _("%s of disk space was reclaimed.") % GLib.format_size(reclaimed)
+        if len(skipped) > 0:
+            text += "\n\n" + _("These web apps are running, close them first: %s") % ", ".join(sorted(skipped))
+        dialog.format_secondary_text(text)
+        dialog.run()
+        dialog.destroy()
+
+    # Computes the disk usage of the webapp profiles in the background
+    @_async
+    def update_disk_usage(self, webapps):
+        for webapp in webapps:
+            self.set_webapp_size(webapp, self.manager.get_disk_usage(webapp))
+        self.manager.disk_usage.save()
+
+    @idle
+    def set_webapp_size(self, webapp, size):
+        iter = self.webapp_rows.get(webapp.path)
+        if iter != None:
+            self.model.set_value(iter, COL_SIZE, GLib.format_size(size) if size != None else "")
 
     def on_run_button(self, widget):
         if self.selected_webapp != None:
-            subprocess.Popen(self.selected_webapp.exec, shell=True)
+            self.launch_webapp(self.selected_webapp)
+
+    # Starts the browser directly (no shell), the child is reaped when it exits
+    def launch_webapp(self, webapp):
+        # The profile is read into the page cache while the browser starts
+        prewarm = self.settings.get_boolean("prewarm-profiles") and webapp.profile != None
+        if prewarm:
+            self.manager.prewarm_webapp(webapp)
+        try:
+            argv = webapp.get_argv()
+            flags = GLib.SpawnFlags.SEARCH_PATH | GLib.SpawnFlags.DO_NOT_REAP_CHILD
+            (pid, stdin, stdout, stderr) = GLib.spawn_async(argv, flags=flags)
+        except Exception as e:
+            print(e)
+            return
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, self.on_webapp_exited)
+        self.watch_launch(webapp, argv, prewarm)
+        if prewarm:
+            GLib.timeout_add_seconds(PREWARM_LEARN_DELAY, self.learn_hot_files, webapp, time.time())
+
+    def learn_hot_files(self, webapp, launch_time):
+        self.manager.learn_hot_files(webapp, launch_time)
+        return GLib.SOURCE_REMOVE
+
+    def on_webapp_exited(self, pid, status):
+        GLib.spawn_close_pid(pid)
+
+    # Measures the time until the window of the webapp is mapped (X11 only, with libwnck)
+    def watch_launch(self, webapp, argv, prewarm):
+        window_class = get_window_class(argv)
+        screen = self.get_wnck_screen()
+        if window_class == None or screen == None:
+            return
+        span = tracer.span("launch", "launch", webapp=webapp.name, prewarm=prewarm)
+        span.__enter__()
+        self.pending_launches[window_class.lower()] = (webapp.name, time.monotonic(), span, prewarm)
+        GLib.timeout_add_seconds(LAUNCH_TIMEOUT, self.forget_launch, window_class.lower())
+
+    def forget_launch(self, window_class):
+        self.pending_launches.pop(window_class, None)
+        return GLib.SOURCE_REMOVE
+
+    def get_wnck_screen(self):
+        if self.wnck_screen == None:
+            self.wnck_screen = False
+            try:
+                gi.require_version("Wnck", "3.0")
+                from gi.repository import Wnck
+                screen = Wnck.Screen.get_default()
+                if screen != None:
+                    # Windows which are already open don't count as opened
+                    screen.force_update()
+                    screen.connect("window-opened", self.on_window_opened)
+                    self.wnck_screen = screen
+            except (ValueError, ImportError) as e:
+                print(e)
+        return self.wnck_screen or None
+
+    def on_window_opened(self, screen, window):
+        for name in [window.get_class_group_name(), window.get_class_instance_name()]:
+            launch = self.pending_launches.pop((name or "").lower(), None)
+            if launch != None:
+                (webapp_name, start, span, prewarm) = launch
+                span.__exit__(None, None, None)
+                print("%s: window mapped %.0f ms after launch%s" % (webapp_name, (time.monotonic() - start) * 1000,
+                                                                    " (prewarmed profile)" if prewarm else ""))
+                break
 
     def on_ok_button(self, widget):
         category = self.category_combo.get_model()[self.category_combo.get_active()][CATEGORY_ID]
@@ -283,6 +545,7 @@ class WebAppManagerWindow():
         url = self.get_url()
         isolate_profile = self.isolated_switch.get_active()
         navbar = self.navbar_switch.get_active()
+        cache_location = self.cache_combo.get_active_id()
         icon = self.icon_chooser.get_icon()
         if "/tmp" in icon:
             # If the icon path is in /tmp, move it.
@@ -290,14 +553,27 @@ class WebAppManagerWindow():
             new_path = os.path.join(ICONS_DIR, filename)
             shutil.copyfile(icon, new_path)
             icon = new_path
+        if icon == self.favicon_path:
+            self.favicon_path = None
+        else:
+            self.discard_favicon()
         if self.edit_mode:
-            self.manager.edit_webapp(self.selected_webapp.path, name, icon, category)
-            self.load_webapps()
+            path = self.selected_webapp.path
+            self.manager.edit_webapp(path, name, icon, category)
         else:
-            self.manager.create_webapp(name, url, icon, category, browser, isolate_profile, navbar)
-            self.load_webapps()
+            path = self.manager.create_webapp(name, url, icon, category, browser, isolate_profile, navbar,
+                                              cache_location, self.settings.get_int("cache-size"))
+        self.update_webapp_row(path)
+        if path in self.webapp_rows and path not in self.matching_paths:
+            # Don't hide the webapp which was just saved
+            self.search_entry.set_text("")
+            self.on_search_changed(self.search_entry)
+        self.select_webapp_row(path)
+        self.show_main_page()
 
     def on_add_button(self, widget):
+        self.discard_favicon()
+        self.prepare_icon_guessing()
         self.name_entry.set_text("")
         self.url_entry.set_text("")
         self.icon_chooser.set_icon("webapp-manager")
@@ -305,6 +581,8 @@ class WebAppManagerWindow():
         self.browser_combo.set_active(0)
         self.isolated_switch.set_active(True)
         self.navbar_switch.set_active(False)
+        if not self.cache_combo.set_active_id(self.settings.get_string("cache-location")):
+            self.cache_combo.set_active(0)
         for widget in self.add_specific_widgets:
             widget.show()
         self.show_hide_browser_widgets()
@@ -335,9 +613,18 @@ class WebAppManagerWindow():
             self.name_entry.grab_focus()
 
     def on_cancel_button(self, widget):
-        self.load_webapps()
+        self.discard_favicon()
+        self.show_main_page()
+
+    # Removes the icon picked on the favicon page, unless a webapp uses it
+    def discard_favicon(self):
+        if self.favicon_path != None:
+            if os.path.exists(self.favicon_path):
+                os.remove(self.favicon_path)
+            self.favicon_path = None
 
     def on_cancel_favicon_button(self, widget):
+        self.cancel_favicon_search()
         self.stack.set_visible_child_name("add_page")
         self.headerbar.set_subtitle(_("Add a New Web App"))
 
@@ -347,7 +634,13 @@ class WebAppManagerWindow():
         self.spinner.show()
         self.favicon_stack.set_visible_child_name("page_spinner")
         self.favicon_button.set_sensitive(False)
-        self.download_icons(url)
+        # Starting a new search cancels the previous one
+        get_task_executor().submit_latest("favicons", self.download_icons, url)
+
+    # Stops the search, its remaining results are ignored
+    def cancel_favicon_search(self):
+        get_task_executor().cancel("favicons")
+        self.reset_favicon_button()
 
     # Reads what's in the URL entry and returns a validated version
     def get_url(self):
@@ -358,48 +651,80 @@ class WebAppManagerWindow():
             url = "http://%s" % url
         return url
 
-    @_async
-    def download_icons(self, url):
-        images = download_favicon(url)
-        self.show_favicons(images)
+    # Runs in the task executor, token is cancelled when another search starts or when the search is cancelled
+    def download_icons(self, token, url):
+        first = True
+        for origin, pil_image in iter_favicons(url):
+            if token.cancelled:
+                break
+            # Icons are handed to GTK from memory, nothing is written to disk until the user picks one
+            pil_image = pil_image.convert("RGBA")
+            pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(pil_image.tobytes()), GdkPixbuf.Colorspace.RGB,
+                                                     True, 8, pil_image.width, pil_image.height, pil_image.width * 4)
+            self.show_favicon(token, origin, pil_image, pixbuf, first)
+            first = False
+        self.end_favicon_search(token)
 
+    # Icons are added to the favicon page as soon as they're downloaded
     @idle
-    def show_favicons(self, images):
-        self.spinner.stop()
-        self.spinner.hide()
-        self.favicon_stack.set_visible_child_name("page_image")
-        self.favicon_button.set_sensitive(True)
-        if len(images) > 0:
+    def show_favicon(self, token, origin, pil_image, pixbuf, first):
+        # Results of an older search
+        if token.cancelled:
+            return
+        box = self.favicon_flow
+        if first:
             self.stack.set_visible_child_name("favicon_page")
             self.headerbar.set_subtitle(_("Choose an icon"))
-            box = self.builder.get_object("favicon_flow")
             for child in box.get_children():
                 box.remove(child)
-            for origin, pil_image, path in images:
-                button = Gtk.Button()
-                content_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
-                image = Gtk.Image()
-                image.set_from_file(path)
-                dimensions = Gtk.Label()
-                dimensions.set_text("%dx%d" % (pil_image.width, pil_image.height))
-                source = Gtk.Label()
-                source.set_text(origin)
-                content_box.pack_start(image, 0, True, True)
-                # content_box.pack_start(source, 0, True, True)
-                content_box.pack_start(dimensions, 0, True, True)
-                button.add(content_box)
-                button.connect("clicked", self.on_favicon_selected, path)
-                box.add(button)
-            box.show_all()
-
-    def on_favicon_selected(self, widget, path):
-        self.icon_chooser.set_icon(path)
+        button = Gtk.Button()
+        button.favicon_height = pil_image.height
+        content_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        image = Gtk.Image.new_from_pixbuf(pixbuf)
+        dimensions = Gtk.Label()
+        dimensions.set_text("%dx%d" % (pil_image.width, pil_image.height))
+        source = Gtk.Label()
+        source.set_text(origin)
+        content_box.pack_start(image, 0, True, True)
+        # content_box.pack_start(source, 0, True, True)
+        content_box.pack_start(dimensions, 0, True, True)
+        button.add(content_box)
+        button.connect("clicked", self.on_favicon_selected, pil_image)
+        box.add(button)
+        box.show_all()
+
+    @idle
+    def end_favicon_search(self, token):
+        if not token.cancelled:
+            self.reset_favicon_button()
+
+    def reset_favicon_button(self):
+        self.spinner.stop()
+        self.spinner.hide()
+        self.favicon_stack.set_visible_child_name("page_image")
+        self.favicon_button.set_sensitive(True)
+
+    # Biggest icons first
+    def sort_favicons(self, child1, child2):
+        return child2.get_child().favicon_height - child1.get_child().favicon_height
+
+    def on_favicon_selected(self, widget, pil_image):
+        self.discard_favicon()
+        try:
+            self.favicon_path = save_icon(pil_image)
+            self.icon_chooser.set_icon(self.favicon_path)
+        except Exception as e:
+            print(e)
         self.stack.set_visible_child_name("add_page")
         self.headerbar.set_subtitle(_("Add a New Web App"))
 
     def on_browser_changed(self, widget):
         self.show_hide_browser_widgets()
 
+    def on_isolated_changed(self, widget, param):
+        if not self.edit_mode:
+            self.show_hide_browser_widgets()
+
     def show_hide_browser_widgets(self):
         browser = self.browser_combo.get_model()[self.browser_combo.get_active()][BROWSER_OBJ]
         if (browser.browser_type == BROWSER_TYPE_FIREFOX):
@@ -412,6 +737,14 @@ class WebAppManagerWindow():
             self.isolated_switch.show()
             self.navbar_label.hide()
             self.navbar_switch.hide()
+        # Firefox profiles are always isolated, Chromium browsers only have their own cache when isolated
+        if browser.browser_type == BROWSER_TYPE_FIREFOX or \
+           (browser.browser_type != BROWSER_TYPE_EPIPHANY and self.isolated_switch.get_active()):
+            self.cache_label.show()
+            self.cache_combo.show()
+        else:
+            self.cache_label.hide()
+            self.cache_combo.hide()
 
     def on_name_entry(self, widget):
         self.toggle_ok_sensitivity()
@@ -422,7 +755,10 @@ class WebAppManagerWindow():
         else:
             self.favicon_button.set_sensitive(False)
         self.toggle_ok_sensitivity()
-        self.guess_icon()
+        # Wait for the user to stop typing before guessing the icon
+        if self.guess_icon_source != None:
+            GLib.source_remove(self.guess_icon_source)
+        self.guess_icon_source = GLib.timeout_add(GUESS_ICON_DELAY, self.guess_icon)
 
     def toggle_ok_sensitivity(self):
         if self.name_entry.get_text() == "":
@@ -432,57 +768,274 @@ class WebAppManagerWindow():
         else:
             self.ok_button.set_sensitive(True)
 
-    def guess_icon(self):
+    def get_hostname(self):
         url = self.get_url().lower()
-        if url != "":
-            info = tldextract.extract(url)
-            icon = None
-            if info.domain == "google" and info.subdomain != None and info.subdomain != "":
-                if info.subdomain == "mail":
-                    icon = "web-%s-gmail" % info.domain
-                else:
-                    icon = "web-%s-%s" % (info.domain, info.subdomain)
-            elif info.domain == "gmail":
-                icon = "web-google-gmail"
-            elif info.domain == "youtube":
-                icon = "web-google-youtube"
-            elif info.domain != None and info.domain != "":
-                icon = "web-%s" % info.domain
-            if icon != None and self.icon_theme.has_icon(icon):
-                self.icon_chooser.set_icon(icon)
+        if url == "":
+            return None
+        return urllib.parse.urlparse(url).hostname
 
-    def load_webapps(self):
-        # Clear treeview and selection
-        self.model.clear()
-        self.selected_webapp = None
-        self.remove_button.set_sensitive(False)
-        self.edit_button.set_sensitive(False)
-        self.run_button.set_sensitive(False)
+    def guess_icon(self):
+        self.guess_icon_source = None
+        hostname = self.get_hostname()
+        if hostname != None:
+            self.find_icon_name(hostname)
+        return GLib.SOURCE_REMOVE
 
-        webapps = self.manager.get_webapps()
-        for webapp in webapps:
-            if webapp.is_valid:
-                if "/" in webapp.icon and os.path.exists(webapp.icon):
-                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(webapp.icon, -1, 32 * self.window.get_scale_factor())
+    # The first lookup loads the public suffix list, so it's done in the background
+    @_async
+    def find_icon_name(self, hostname):
+        icon = get_icon_name(hostname)
+        if icon != None:
+            self.set_guessed_icon(hostname, icon)
+
+    @idle
+    def set_guessed_icon(self, hostname, icon):
+        # Ignore the result if the URL changed in the meantime
+        if hostname == self.get_hostname() and icon in self.get_web_icons():
+            self.icon_chooser.set_icon(icon)
+
+    def get_web_icons(self):
+        if self.web_icons == None:
+            self.web_icons = set(name for name in self.icon_theme.list_icons(None) if name.startswith("web-"))
+        return self.web_icons
+
+    # Loads what's needed to guess icons before the user types a URL
+    def prepare_icon_guessing(self):
+        self.load_suffix_list()
+        GLib.idle_add(self.load_web_icons)
+
+    def load_web_icons(self):
+        self.get_web_icons()
+        return GLib.SOURCE_REMOVE
+
+    @_async
+    def load_suffix_list(self):
+        get_tld_extractor()
+
+    def on_icon_theme_changed(self, icon_theme):
+        self.web_icons = None
+
+    def get_placeholder_pixbuf(self):
+        scale = self.window.get_scale_factor()
+        if scale not in self.placeholder_pixbufs:
+            self.placeholder_pixbufs[scale] = self.icon_theme.load_icon("webapp-manager", ICON_SIZE * scale, 0)
+        return self.placeholder_pixbufs[scale]
+
+    # Returns the image file of a webapp icon, resolving theme icon names
+    def get_icon_filename(self, icon, size):
+        if "/" in icon and os.path.exists(icon):
+            return icon
+        info = None
+        if self.icon_theme.has_icon(icon):
+            info = self.icon_theme.lookup_icon(icon, size, 0)
+        if info == None:
+            info = self.icon_theme.lookup_icon("webapp-manager", size, 0)
+        if info == None:
+            return None
+        return info.get_filename()
+
+    # Rows show a placeholder until their icon is decoded by a worker thread
+    def load_webapp_icon(self, webapp):
+        size = ICON_SIZE * self.window.get_scale_factor()
+        filename = self.get_icon_filename(webapp.icon, size)
+        if filename != None:
+            self.icon_executor.submit(self.decode_icon, webapp, filename, size)
+
+    def decode_icon(self, webapp, filename, size):
+        try:
+            with tracer.span("decode icon", "icons", file=filename, size=size) as span:
+                key = "%s:%d:%d" % (filename, os.stat(filename).st_mtime_ns, size)
+                data = self.thumbnails.get(key)
+                span.set("thumbnail", data != None)
+                if data != None:
+                    stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(data))
+                    pixbuf = GdkPixbuf.Pixbuf.new_from_stream(stream, None)
                 else:
-                    if self.icon_theme.has_icon(webapp.icon):
-                        pixbuf = self.icon_theme.load_icon(webapp.icon, 32 * self.window.get_scale_factor(), 0)
-                    else:
-                        pixbuf = self.icon_theme.load_icon("webapp-manager", 32 * self.window.get_scale_factor(), 0)
+                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, -1, size)
+                    success, data = pixbuf.save_to_bufferv("png", [], [])
+                    if success:
+                        self.thumbnails.put(key, data)
+            self.set_webapp_icon(webapp, pixbuf)
+        except Exception as e:
+            print(e)
+
+    @idle
+    def set_webapp_icon(self, webapp, pixbuf):
+        iter = self.webapp_rows.get(webapp.path)
+        if iter != None and self.model.get_value(iter, COL_WEBAPP).icon == webapp.icon:
+            self.model.set_value(iter, COL_ICON, pixbuf)
+
+    # Adds, updates or removes the row of a single launcher, without touching the other rows
+    def update_webapp_row(self, path):
+        webapp = self.manager.get_webapp(path)
+        if webapp == None:
+            self.remove_webapp_row(path)
+        else:
+            self.set_webapp_row(webapp)
+            self.update_disk_usage([webapp])
+        self.schedule_index_save()
+
+    # The launcher index is written once for a burst of changes, rather than for each launcher
+    def schedule_index_save(self):
+        if self.index_save_source == None:
+            self.index_save_source = GLib.timeout_add_seconds(INDEX_SAVE_DELAY, self.save_index)
+
+    def save_index(self):
+        self.index_save_source = None
+        self.manager.index.flush()
+        return GLib.SOURCE_REMOVE
+
+    def set_webapp_row(self, webapp):
+        iter = self.webapp_rows.get(webapp.path)
+        visible = self.matches_search(webapp.search_key)
+        self.search_keys[webapp.path] = webapp.search_key
+        if visible:
+            self.matching_paths.add(webapp.path)
+        else:
+            self.matching_paths.discard(webapp.path)
+        if iter == None:
+            iter = self.model.insert_with_values(None, -1, [COL_ICON, COL_NAME, COL_WEBAPP, COL_VISIBLE],
+                                                 [self.get_placeholder_pixbuf(), webapp.name, webapp, visible])
+            self.webapp_rows[webapp.path] = iter
+            self.load_webapp_icon(webapp)
+            return
+        old_webapp = self.model.get_value(iter, COL_WEBAPP)
+        if old_webapp is webapp:
+            # The launcher index returns the same record when the file didn't change
+            return
+        self.model.set_value(iter, COL_NAME, webapp.name)
+        self.model.set_value(iter, COL_WEBAPP, webapp)
+        self.model.set_value(iter, COL_VISIBLE, visible)
+        if old_webapp.icon != webapp.icon:
+            self.load_webapp_icon(webapp)
+        if self.selected_webapp is old_webapp:
+            self.selected_webapp = webapp
+
+    def remove_webapp_row(self, path):
+        iter = self.webapp_rows.pop(path, None)
+        self.surfaces.pop(path, None)
+        self.search_keys.pop(path, None)
+        self.matching_paths.discard(path)
+        if iter != None:
+            self.model.remove(iter)
+
+    def select_webapp_row(self, path):
+        iter = self.webapp_rows.get(path)
+        if iter != None and path in self.matching_paths:
+            (success, filter_iter) = self.filter.convert_child_iter_to_iter(iter)
+            if success:
+                self.treeview.get_selection().select_iter(filter_iter)
+
+    def matches_search(self, search_key):
+        for term in self.search_terms:
+            if term not in search_key:
+                return False
+        return True
+
+    def on_search_changed(self, entry):
+        query = entry.get_text().casefold()
+        # Extending the query can only hide rows, so only the visible ones are checked again
+        if query.startswith(self.search_query):
+            candidates = self.matching_paths
+        else:
+            candidates = self.search_keys.keys()
+        self.search_query = query
+        self.search_terms = query.split()
+        with tracer.span("filter", "search", query=query, candidates=len(candidates)):
+            matching_paths = set(path for path in candidates if self.matches_search(self.search_keys[path]))
+            # Only the rows whose visibility changed are updated
+            for path in self.matching_paths - matching_paths:
+                self.model.set_value(self.webapp_rows[path], COL_VISIBLE, False)
+            for path in matching_paths - self.matching_paths:
+                self.model.set_value(self.webapp_rows[path], COL_VISIBLE, True)
+            self.matching_paths = matching_paths
+        if self.treeview.get_selection().count_selected_rows() == 0:
+            self.select_first_webapp()
 
-                iter = self.model.insert_before(None, None)
-                self.model.set_value(iter, COL_ICON, pixbuf)
-                self.model.set_value(iter, COL_NAME, webapp.name)
-                self.model.set_value(iter, COL_WEBAPP, webapp)
+    def on_stop_search(self, entry):
+        entry.set_text("")
+        self.treeview.grab_focus()
 
-        # Select the 1st web-app
+    # Enter in the search entry launches the selected webapp
+    def on_search_activated(self, entry):
+        if self.selected_webapp != None:
+            self.launch_webapp(self.selected_webapp)
+
+    # Events are coalesced per launcher (a new file gets both CREATED and CHANGES_DONE_HINT),
+    # each changed launcher is read once per LAUNCHER_CHANGES_DELAY
+    def on_apps_dir_changed(self, monitor, file, other_file, event_type):
+        if event_type in [Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                          Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_IN,
+                          Gio.FileMonitorEvent.MOVED_OUT]:
+            self.changed_launchers.add(file.get_path())
+        elif event_type == Gio.FileMonitorEvent.RENAMED:
+            self.changed_launchers.add(file.get_path())
+            self.changed_launchers.add(other_file.get_path())
+        else:
+            return
+        if self.launcher_changes_source == None:
+            self.launcher_changes_source = GLib.timeout_add(LAUNCHER_CHANGES_DELAY, self.update_changed_launchers)
+
+    def update_changed_launchers(self):
+        self.launcher_changes_source = None
+        webapps = []
+        for path in self.changed_launchers:
+            webapp = self.manager.get_webapp(path)
+            if webapp == None:
+                self.remove_webapp_row(path)
+            else:
+                self.set_webapp_row(webapp)
+                webapps.append(webapp)
+        self.changed_launchers.clear()
+        if len(webapps) > 0:
+            self.update_disk_usage(webapps)
+        self.schedule_index_save()
+        if self.treeview.get_selection().count_selected_rows() == 0:
+            self.select_first_webapp()
+        return GLib.SOURCE_REMOVE
+
+    def on_icons_dir_changed(self, monitor, file, other_file, event_type):
+        if event_type not in [Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.DELETED,
+                              Gio.FileMonitorEvent.MOVED_IN, Gio.FileMonitorEvent.RENAMED]:
+            return
+        paths = [file.get_path()]
+        if other_file != None:
+            paths.append(other_file.get_path())
+        for iter in self.webapp_rows.values():
+            webapp = self.model.get_value(iter, COL_WEBAPP)
+            if webapp.icon in paths:
+                self.load_webapp_icon(webapp)
+
+    def select_first_webapp(self):
         path = Gtk.TreePath.new_first()
         self.treeview.get_selection().select_path(path)
 
-        # Switch to main page
+    # Leaving the add page (OK, Cancel or Escape) drops the favicon search in progress
+    def show_main_page(self):
+        self.cancel_favicon_search()
         self.stack.set_visible_child_name("main_page")
         self.headerbar.set_subtitle(_("Run websites as if they were apps"))
 
+    # Synchronizes the list with the launchers directory, only the rows which changed are updated
+    def load_webapps(self):
+        webapps = self.manager.get_webapps()
+        paths = set()
+        with tracer.span("fill list", "launchers", webapps=len(webapps)):
+            for webapp in webapps:
+                paths.add(webapp.path)
+                self.set_webapp_row(webapp)
+            for path in list(self.webapp_rows.keys()):
+                if path not in paths:
+                    self.remove_webapp_row(path)
+        self.update_disk_usage(webapps)
+
+        # Keep the current selection, or select the 1st web-app
+        if self.treeview.get_selection().count_selected_rows() == 0:
+            self.select_first_webapp()
+
+        # Switch to main page
+        self.show_main_page()
+
 
 if __name__ == "__main__":
     application = MyApplication("org.x.webapp-manager", Gio.ApplicationFlags.FLAGS_NONE)